@@ -0,0 +1,123 @@
+import argparse
+import multiprocessing
+import os
+import random
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from helpers import StochasticCSA
+
+BatchQuery = namedtuple("BatchQuery", [
+    "origin", # station name
+    "destination", # station name, None for the times to all stations
+    "departure_time",
+    "tolerance",
+])
+
+# planner data of the worker processes, inherited from the parent by fork
+_worker_data = None
+_worker_trip_window = None
+
+
+def station_times(data, result, departure_idx, trip_window):
+    """ Times from the origin to all stations (by name) of a OneToAllResult, trip_window*60 min if unreachable """
+    trip_length = {}
+    for arrival_idx, minutes in enumerate(result.travel_minutes().tolist()):
+        trip_length[data.index_station[arrival_idx]] = trip_window * 60 if minutes != minutes else int(minutes) # nan if unreachable
+    trip_length[data.index_station[departure_idx]] = 0.
+    return trip_length
+
+
+def group_queries(data, queries):
+    """
+    Groups the queries by origin and departure time, returns a list of
+    (origin idx, departure time, [(query idx, destination idx or None, tolerance)]),
+    the largest groups first
+    """
+    groups = {}
+    for i, query in enumerate(queries):
+        destination = None if query.destination is None else data.station_idx[query.destination]
+        groups.setdefault((data.station_idx[query.origin], query.departure_time), []).append((i, destination, query.tolerance))
+    return sorted(((origin, departure_time, members) for (origin, departure_time), members in groups.items()),
+                  key=lambda group: -len(group[2]))
+
+
+def run_group(data, group, trip_window):
+    """
+    Answers all the queries of a group with a single one-to-all scan at all their
+    tolerances, returns a list of (query idx, route or times to all stations)
+    """
+    origin, departure_time, members = group
+    csa = StochasticCSA(data.stochastic_timetable, data.footpaths)
+    csa.compute(origin, departure_time, [tolerance for _, _, tolerance in members], trip_window)
+    results = []
+    for i, destination, tolerance in members:
+        if destination is None:
+            results.append((i, station_times(data, csa.one_to_all(tolerance), origin, trip_window)))
+        else:
+            results.append((i, csa.get_route(origin, destination, departure_time, tolerance=tolerance)))
+    return results
+
+
+def _init_worker(data, trip_window):
+    global _worker_data, _worker_trip_window
+    _worker_data, _worker_trip_window = data, trip_window
+
+
+def _run_group_worker(group):
+    return run_group(_worker_data, group, _worker_trip_window)
+
+
+def run_batch(data, queries, trip_window=4, processes=None):
+    """
+    Answers a batch of BatchQuery and yields (query idx, result) as the groups
+    complete, in no particular order. The groups are spread over 'processes' worker
+    processes (all the cores by default) that are forked from the current one, so
+    that they share the memory-mapped timetable and the footpaths with it instead
+    of receiving a pickled copy: only the groups and the results are sent around.
+    Runs serially with processes=1, or where fork is not available.
+    """
+    groups = group_queries(data, queries)
+    processes = min(processes or os.cpu_count() or 1, len(groups))
+    if processes <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for group in groups:
+            yield from run_group(data, group, trip_window)
+        return
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes, initializer=_init_worker, initargs=(data, trip_window)) as pool:
+        for results in pool.imap_unordered(_run_group_worker, groups):
+            yield from results
+
+
+def random_queries(data, n_origins, n_destinations, departure_times, tolerances, seed=0):
+    """ Random batch for benchmarks: n_destinations destinations for each origin and departure time """
+    rng = random.Random(seed)
+    names = [data.index_station[idx] for idx in range(data.n_stations)]
+    queries = []
+    for origin in rng.sample(names, n_origins):
+        for departure_time in departure_times:
+            for destination in rng.sample(names, n_destinations):
+                queries.append(BatchQuery(origin, destination, departure_time, rng.choice(tolerances)))
+    return queries
+
+
+if __name__=="__main__":
+    from datastore import load_planner_data
+
+    parser = argparse.ArgumentParser(description="Runs a random batch of queries with an increasing number of processes")
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--origins", type=int, default=32)
+    parser.add_argument("--destinations", type=int, default=20)
+    parser.add_argument("--times", nargs="+", default=["08:00", "12:00", "17:30"], help="departure times (HH:MM)")
+    parser.add_argument("--date", default="2019-01-02")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    args = parser.parse_args()
+    data = load_planner_data(args.mappings_dirpath)
+    departure_times = [datetime.strptime(args.date + " " + t, "%Y-%m-%d %H:%M") for t in args.times]
+    queries = random_queries(data, args.origins, args.destinations, departure_times, [0.5, 0.75, 0.9])
+    for processes in sorted(set(args.processes)):
+        start = time.perf_counter()
+        n_results = sum(1 for _ in run_batch(data, queries, processes=processes))
+        elapsed = time.perf_counter() - start
+        print(f"{processes} processes: {n_results} queries in {elapsed:.2f} s ({n_results / elapsed:.1f} queries/s)")
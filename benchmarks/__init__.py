@@ -0,0 +1,6 @@
+"""
+Benchmarks of the journey planner, run as modules from the root of the repository, e.g.
+
+    python -m benchmarks.bench_stochastic_table saved_data
+    python -m benchmarks.suite --synthetic 1000
+"""
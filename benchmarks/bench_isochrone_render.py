@@ -0,0 +1,78 @@
+"""
+Renders the four isochrone maps of the /iso page in each rendering mode of
+mapmaker and reports the render time and the size of what the browser loads:
+
+    markers  one folium page per tolerance, one CircleMarker (and popup) per station
+    geojson  one folium page per tolerance, all stations in a single GeoJSON layer
+    payload  one compact JSON payload for all tolerances, drawn by static/iso_map.html
+
+    python -m benchmarks.bench_isochrone_render saved_data --origin "Zürich HB"
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flaskcode"))
+import mapmaker
+
+from interface import FrontBackInterface
+
+TOLERANCES = [0.5, 0.75, 0.9, 1.0]
+STATIC_BASE_MAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flaskcode", "static", "iso_map.html")
+
+
+def isochrones_from_times(times, fbi):
+    """ Same bands as the /iso page: 15 minutes each up to 150 minutes, then 150 minutes or more """
+    t_ranges = [range(k*15, (k+1)*15) for k in range(9)] + [range(150, 241)]
+    isochrones = [[] for _ in t_ranges]
+    for station_name, minutes in times.items():
+        if station_name not in fbi.station_coord:
+            continue
+        for i, t_range in enumerate(t_ranges):
+            if minutes in t_range:
+                isochrones[i].append((station_name, minutes, fbi.latlon(station_name)))
+    return isochrones
+
+
+def render(mode, isochrones_by_tolerance):
+    """ Returns the rendered documents of a mode """
+    if mode == "payload":
+        with open(STATIC_BASE_MAP) as base_map:
+            # the base map is static and cached by the browser, it is only loaded once
+            return [base_map.read(), mapmaker.isochrones_payload(isochrones_by_tolerance)]
+    render_one = mapmaker.isochrones_html if mode == "markers" else mapmaker.isochrones_geojson_html
+    return [render_one(isochrones) for isochrones in isochrones_by_tolerance.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--origin", default="Zürich HB")
+    parser.add_argument("--departure", default="2019-01-02 12:00", help="YYYY-MM-DD HH:MM")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    fbi = FrontBackInterface(args.mappings_dirpath, cache=None)
+    departure_time = datetime.strptime(args.departure, "%Y-%m-%d %H:%M")
+    times_by_tolerance = fbi.times_to_stations_by_tolerance(fbi.station_idx[args.origin], departure_time, TOLERANCES)
+    isochrones_by_tolerance = {tolerance: isochrones_from_times(times_by_tolerance[tolerance], fbi) for tolerance in TOLERANCES}
+    n_stations = sum(len(isochrone) for isochrone in isochrones_by_tolerance[TOLERANCES[0]])
+
+    print(f"{len(TOLERANCES)} isochrone maps of {n_stations} stations from {args.origin}, best of {args.repeat}")
+    print(f"{'mode':10s}{'render (ms)':>14s}{'size (kB)':>12s}{'gzip (kB)':>12s}")
+    for mode in ("markers", "geojson", "payload"):
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            documents = render(mode, isochrones_by_tolerance)
+            best = min(best, time.perf_counter() - start)
+        size = sum(len(document.encode("utf8")) for document in documents)
+        gzip_size = sum(len(gzip.compress(document.encode("utf8"))) for document in documents)
+        print(f"{mode:10s}{best * 1e3:14.1f}{size / 1e3:12.1f}{gzip_size / 1e3:12.1f}")
+
+
+if __name__=="__main__":
+    main()
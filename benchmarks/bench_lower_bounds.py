@@ -0,0 +1,88 @@
+"""
+Runs the same random point-to-point queries with and without the travel time lower
+bounds of lower_bounds.py, checks that they find the same routes, and reports the
+connections and footpaths each scan went through and the compute time per query.
+The lower bounds are built in memory if the data directory has none.
+
+    python -m benchmarks.bench_lower_bounds saved_data --queries 200
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from datastore import load_planner_data
+from helpers import StochasticCSA
+from lower_bounds import build_lower_bounds
+from metrics import QueryStats
+
+TOLERANCES = [0, 0.5, 0.8, 0.95]
+COUNTERS = ("connections_scanned", "connections_pruned", "connections_reachable", "connections_feasible", "footpath_relaxations")
+
+
+def random_queries(data, n, trip_window, seed):
+    """ (origin, destination, departure time, tolerance) between stations served by the timetable """
+    tt = data.stochastic_timetable
+    rng = random.Random(seed)
+    origins = sorted(set(tt.departure_station.tolist()))
+    destinations = sorted(set(tt.arrival_station.tolist()))
+    first, last = tt.service_period()
+    span = max(int((last - first).total_seconds() // 60) - int(trip_window * 60), 1)
+    return [(rng.choice(origins), rng.choice(destinations), first + timedelta(minutes=rng.randrange(span)), rng.choice(TOLERANCES))
+            for _ in range(n)]
+
+
+def run(data, queries, lower_bounds, trip_window):
+    """ Routes, summed counters and per-query compute times (best of the repeats is taken by the caller) """
+    routes, counters, seconds = [], dict.fromkeys(COUNTERS, 0), []
+    for origin, destination, departure_time, tolerance in queries:
+        csa = StochasticCSA(data.stochastic_timetable, data.footpaths, lower_bounds)
+        stats = QueryStats("route")
+        start = time.perf_counter()
+        csa.compute(origin, departure_time, tolerance, trip_window, arrival_station=destination)
+        seconds.append(time.perf_counter() - start)
+        # the counters are collected in a separate run, so that they do not weigh on the timings
+        csa.compute(origin, departure_time, tolerance, trip_window, arrival_station=destination, stats=stats)
+        routes.append(csa.get_route(origin, destination, departure_time))
+        for name in COUNTERS:
+            counters[name] += stats.counters[name]
+    return routes, counters, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--trip-window", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = load_planner_data(args.mappings_dirpath)
+    lower_bounds = data.lower_bounds
+    if lower_bounds is None:
+        start = time.perf_counter()
+        lower_bounds = build_lower_bounds(data.stochastic_timetable, data.footpaths)
+        print(f"built the lower bounds of {data.n_stations} stations in {time.perf_counter() - start:.2f} s")
+    queries = random_queries(data, args.queries, args.trip_window, args.seed)
+
+    results = {}
+    for _ in range(args.repeat):
+        # alternates the two variants, so that both see the same load of the machine
+        for name, bounds in (("no bounds", None), ("lower bounds", lower_bounds)):
+            routes, counters, seconds = run(data, queries, bounds, args.trip_window)
+            if name not in results or sum(seconds) < sum(results[name][2]):
+                results[name] = (routes, counters, seconds)
+    unchanged = sum(a == b for a, b in zip(results["no bounds"][0], results["lower bounds"][0]))
+
+    print(f"{len(queries)} queries, {unchanged} identical routes, best of {args.repeat}")
+    print(f"{'':14s}" + "".join(f"{name.replace('connections_', '').replace('footpath_', ''):>12s}" for name in COUNTERS) + f"{'ms/query':>12s}")
+    for name, (_, counters, seconds) in results.items():
+        print(f"{name:14s}" + "".join(f"{counters[counter] / len(queries):12.0f}" for counter in COUNTERS)
+              + f"{sum(seconds) / len(queries) * 1e3:12.2f}")
+    if unchanged != len(queries):
+        raise SystemExit("the lower bounds changed some routes")
+
+
+if __name__=="__main__":
+    main()
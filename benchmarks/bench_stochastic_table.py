@@ -0,0 +1,165 @@
+"""
+Replays the StochasticTable operations of real queries on the list-of-tuples table
+the planner used before and on the current bisect-based one, and reports the time
+spent per query, overall and for one dense station (Zürich HB by default).
+
+    python -m benchmarks.bench_stochastic_table saved_data --station "Zürich HB" --queries 20
+"""
+import argparse
+import random
+import time
+from datetime import timedelta
+
+from datastore import load_planner_data
+from helpers import StochasticCSA
+
+
+class ListStochasticTable:
+    """ The previous StochasticTable: a list of (connection, arrival, in_route, probability) tuples """
+
+    CONNECTION_IDX = 0
+    ARRIVAL_TS = 1
+    IN_ROUTE = 2
+    ROUTE_PROB = 3
+
+    def __init__(self, max_ts):
+        self.entries = [(-1,max_ts,-1,0)]
+
+    def update_table(self, connection_idx, arrival_ts, in_route, route_prob):
+        new_entry = (connection_idx, arrival_ts, in_route, route_prob)
+        if arrival_ts > self.entries[-1][self.ARRIVAL_TS]:
+            if route_prob > self.entries [-1][self.ROUTE_PROB]:
+                self.entries.append(new_entry)
+        else:
+            i = 0
+            prev_prob = 0
+            while arrival_ts > self.entries[i][self.ARRIVAL_TS]:
+                prev_prob = self.entries[i][self.ROUTE_PROB]
+                i += 1
+            if route_prob > prev_prob:
+                next_ts = self.entries[i][self.ARRIVAL_TS]
+                next_prob = self.entries[i][self.ROUTE_PROB]
+                if route_prob >= next_prob:
+                    j = i
+                    while j < len(self.entries) and route_prob >= self.entries[j][self.ROUTE_PROB]:
+                        j += 1
+                    self.entries = self.entries[:i] + [new_entry] + self.entries[j:]
+                elif arrival_ts != next_ts:
+                    self.entries = self.entries[:i] + [new_entry] + self.entries[i:]
+
+    def best_connecting(self, connection_cdf, departure_timestamp):
+        max_e_idx = -1
+        max_prb = 0
+        for e_idx, e in enumerate(self.entries):
+            arrival_timestamp = e[self.ARRIVAL_TS]
+            if arrival_timestamp <= departure_timestamp:
+                c_idx = e[self.CONNECTION_IDX]
+                route_prb = e[self.ROUTE_PROB]
+                difference = int(departure_timestamp - arrival_timestamp)
+                if difference >= 10 or c_idx == -1:
+                    extended_route_prb = route_prb
+                else:
+                    extended_route_prb = route_prb * connection_cdf(c_idx)[difference]
+                if extended_route_prb > max_prb:
+                    max_e_idx = e_idx
+                    max_prb = extended_route_prb
+        return max_e_idx, max_prb
+
+
+def record_query(data, departure_station, departure_time, tolerance, trip_window):
+    """ Runs one query and returns the trace of table operations: (station, is_update, args) """
+    trace = []
+
+    class RecordingTable(StochasticCSA.StochasticTable):
+        __slots__ = ("station",)
+        n_tables = 0
+
+        def __init__(self, max_ts):
+            super().__init__(max_ts)
+            self.station = RecordingTable.n_tables
+            RecordingTable.n_tables += 1
+
+        def update_table(self, *args):
+            trace.append((self.station, True, args))
+            super().update_table(*args)
+
+        def best_connecting(self, departure_timestamp):
+            trace.append((self.station, False, departure_timestamp))
+            return super().best_connecting(departure_timestamp)
+
+    class RecordingCSA(StochasticCSA):
+        StochasticTable = RecordingTable
+
+    csa = RecordingCSA(data.stochastic_timetable, data.footpaths)
+    csa.compute(departure_station, departure_time, tolerance, trip_window)
+    return trace, csa.max_ts
+
+
+def replay(trace, max_ts, n_stations, connection_cdf, legacy):
+    """ Replays a trace on fresh tables, returns the elapsed time and the best_connecting probabilities """
+    if legacy:
+        tables = [ListStochasticTable(max_ts) for _ in range(n_stations)]
+    else:
+        tables = [StochasticCSA.StochasticTable(max_ts) for _ in range(n_stations)]
+    probs = []
+    start = time.perf_counter()
+    for station, is_update, args in trace:
+        if is_update:
+            if legacy:
+                tables[station].update_table(*args[:4])
+            else:
+                tables[station].update_table(*args)
+        elif legacy:
+            probs.append(tables[station].best_connecting(connection_cdf, args)[1])
+        else:
+            probs.append(tables[station].best_connecting(args)[1])
+    return time.perf_counter() - start, probs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--station", default="Zürich HB", help="dense station to report on")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--trip-window", type=float, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = load_planner_data(args.mappings_dirpath)
+    tt = data.stochastic_timetable
+    cdf_rows, cdf_idx = tt.cdf_rows(), tt.cdf.tolist()
+    connection_cdf = lambda c_idx: cdf_rows[cdf_idx[c_idx]]
+    focus = data.station_idx[args.station]
+    first, last = tt.service_period()
+    span = max(int((last - first).total_seconds() // 60) - int(args.trip_window * 60), 1)
+    random.seed(args.seed)
+    origins = sorted(set(tt.departure_station.tolist()))
+
+    totals = {"legacy": 0., "current": 0., "legacy_focus": 0., "current_focus": 0.}
+    n_ops = n_focus_ops = 0
+    for _ in range(args.queries):
+        departure_time = first + timedelta(minutes=random.randrange(span))
+        trace, max_ts = record_query(data, random.choice(origins), departure_time, args.tolerance, args.trip_window)
+        focus_trace = [op for op in trace if op[0] == focus]
+        n_ops += len(trace)
+        n_focus_ops += len(focus_trace)
+        for name, legacy in (("legacy", True), ("current", False)):
+            elapsed, probs = replay(trace, max_ts, data.n_stations, connection_cdf, legacy)
+            totals[name] += elapsed
+            totals[name + "_focus"] += replay(focus_trace, max_ts, data.n_stations, connection_cdf, legacy)[0]
+            if legacy:
+                legacy_probs = probs
+            elif any(abs(p - q) > 1e-12 for p, q in zip(probs, legacy_probs)):
+                raise AssertionError("the tables disagree on best_connecting")
+
+    n = args.queries
+    print(f"{n} queries, {n_ops / n:.0f} table operations per query, {n_focus_ops / n:.0f} at {args.station}")
+    print(f"{'':20s}{'legacy (ms)':>14s}{'current (ms)':>14s}{'speedup':>10s}")
+    for label, key in (("all stations", ""), (args.station, "_focus")):
+        legacy, current = totals["legacy" + key] / n * 1e3, totals["current" + key] / n * 1e3
+        print(f"{label:20s}{legacy:14.2f}{current:14.2f}{legacy / max(current, 1e-9):9.1f}x")
+
+
+if __name__=="__main__":
+    main()
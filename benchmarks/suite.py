@@ -0,0 +1,302 @@
+"""
+Benchmark suite of the planner, on a data directory or on a synthetic network
+generated on the fly. Measures the latency (percentiles), throughput and peak
+memory of:
+
+    compute             StochasticCSA.compute towards a destination
+    get_route           route reconstruction after compute
+    times_to_stations   one-to-all scan (the isochrone queries)
+    update_table        StochasticTable.update_table, replayed from real queries
+    best_connecting     StochasticTable.best_connecting, replayed from real queries
+    flask_result        /result page and its map, through the Flask test client
+    flask_iso           /iso page and its map payload, through the Flask test client
+
+and writes the results as JSON. With --compare, the median latencies are compared
+to a previous run, and the exit status is 1 if one of them is slower by more than
+--max-slowdown.
+
+    python -m benchmarks.suite --synthetic 1000 --queries 50 --out bench.json
+    python -m benchmarks.suite saved_data --compare bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.bench_stochastic_table import record_query
+from datastore import load_planner_data, max_rss_mb
+from helpers import StochasticCSA
+from interface import FrontBackInterface
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(latencies, **extra):
+    """ Latency percentiles (ms), throughput and peak RSS of a list of latencies in seconds """
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if len(latencies) == 0:
+        return dict(n=0, **extra)
+    ms = latencies * 1e3
+    return dict(
+        n=len(latencies),
+        mean_ms=float(ms.mean()),
+        p50_ms=float(np.percentile(ms, 50)),
+        p90_ms=float(np.percentile(ms, 90)),
+        p99_ms=float(np.percentile(ms, 99)),
+        max_ms=float(ms.max()),
+        throughput_per_s=float(len(latencies) / max(latencies.sum(), 1e-12)),
+        peak_rss_mb=max_rss_mb(),
+        **extra,
+    )
+
+
+def peak_allocation_mb(run):
+    """ Peak memory allocated by Python objects while running run(), in MB (traced separately from the timings) """
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def random_queries(data, n, tolerance, trip_window, seed):
+    """ (origin, destination, departure_time) between stations served by the timetable, leaving in its service period """
+    tt = data.stochastic_timetable
+    rng = random.Random(seed)
+    origins = sorted(set(tt.departure_station.tolist()))
+    destinations = sorted(set(tt.arrival_station.tolist()))
+    first, last = tt.service_period()
+    span = max(int((last - first).total_seconds() // 60) - int(trip_window * 60), 1)
+    return [(rng.choice(origins), rng.choice(destinations), first + timedelta(minutes=rng.randrange(span))) for _ in range(n)]
+
+
+def bench_compute(data, queries, tolerance, trip_window):
+    """ compute and get_route, returns their summaries and the queries that have a route """
+    compute_latencies, route_latencies, routed = [], [], []
+    for origin, destination, departure_time in queries:
+        csa = StochasticCSA(data.stochastic_timetable, data.footpaths, data.lower_bounds)
+        start = time.perf_counter()
+        csa.compute(origin, departure_time, tolerance, trip_window, arrival_station=destination)
+        computed = time.perf_counter()
+        route = csa.get_route(origin, destination, departure_time)
+        route_latencies.append(time.perf_counter() - computed)
+        compute_latencies.append(computed - start)
+        if route:
+            routed.append((origin, destination, departure_time))
+
+    origin, destination, departure_time = queries[0]
+    csa = StochasticCSA(data.stochastic_timetable, data.footpaths, data.lower_bounds)
+    peak_mb = peak_allocation_mb(lambda: csa.compute(origin, departure_time, tolerance, trip_window, arrival_station=destination))
+    return {
+        "compute": summarize(compute_latencies, routes_found=len(routed), peak_alloc_mb=peak_mb),
+        "get_route": summarize(route_latencies),
+    }, routed
+
+
+def bench_times_to_stations(fbi, queries, tolerance, trip_window):
+    latencies = []
+    for origin, _, departure_time in queries:
+        start = time.perf_counter()
+        fbi.times_to_stations(origin, departure_time, tolerance, trip_window=trip_window)
+        latencies.append(time.perf_counter() - start)
+    origin, _, departure_time = queries[0]
+    peak_mb = peak_allocation_mb(lambda: fbi.times_to_stations(origin, departure_time, tolerance, trip_window=trip_window))
+    return {"times_to_stations": summarize(latencies, peak_alloc_mb=peak_mb)}
+
+
+def bench_table_ops(data, queries, tolerance, trip_window):
+    """ Replays the table operations of one-to-all queries on fresh tables, timing each operation """
+    update_latencies, connecting_latencies = [], []
+    for origin, _, departure_time in queries:
+        trace, max_ts = record_query(data, origin, departure_time, tolerance, trip_window)
+        tables = [StochasticCSA.StochasticTable(max_ts) for _ in range(data.n_stations)]
+        clock = time.perf_counter
+        for station, is_update, args in trace:
+            table = tables[station]
+            if is_update:
+                start = clock()
+                table.update_table(*args)
+                update_latencies.append(clock() - start)
+            else:
+                start = clock()
+                table.best_connecting(args)
+                connecting_latencies.append(clock() - start)
+    return {"update_table": summarize(update_latencies), "best_connecting": summarize(connecting_latencies)}
+
+
+def load_flask_app(mappings_dirpath, cache):
+    """
+    Imports the web server with 'mappings_dirpath' as its saved_data, from a temporary
+    working directory (the server reads its data and cache from relative paths).
+    Returns the test client and the working directory.
+    """
+    workdir = tempfile.mkdtemp(prefix="bench_flask_")
+    os.symlink(os.path.abspath(mappings_dirpath), os.path.join(workdir, "saved_data"))
+    for dirpath in (ROOT_DIRPATH, os.path.join(ROOT_DIRPATH, "flaskcode")):
+        if dirpath not in sys.path:
+            sys.path.insert(0, dirpath)
+    os.chdir(workdir)
+    import journey_planner_main
+    if not cache:
+        journey_planner_main.fbi.cache = None
+    return journey_planner_main.app.test_client(), workdir
+
+
+def fetch_maps(client, page):
+    """ Fetches the maps (or map payloads) a page references, as its iframes would """
+    for key in re.findall(r"map(?:\?|%3F)key(?:=|%3D)([0-9a-f]+)", page.get_data(as_text=True)):
+        if client.get("/map", query_string={"key": key}).status_code != 200:
+            raise RuntimeError("map %s was not rendered" % key)
+
+
+def bench_flask(client, index_station, routed, queries, tolerance):
+    result_latencies, iso_latencies, errors = [], [], 0
+    for origin, destination, departure_time in routed:
+        start = time.perf_counter()
+        page = client.get("/result", query_string={
+            "stn_from": index_station[origin], "stn_to": index_station[destination], "qvalue": int(round(tolerance * 100)),
+            "date": departure_time.strftime("%Y-%m-%d"), "time": departure_time.strftime("%H:%M")})
+        if page.status_code == 200:
+            fetch_maps(client, page)
+            result_latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+    for origin, _, departure_time in queries:
+        start = time.perf_counter()
+        page = client.get("/iso", query_string={
+            "stn_origin": index_station[origin], "date": departure_time.strftime("%Y-%m-%d"), "time": departure_time.strftime("%H:%M")})
+        if page.status_code == 200:
+            fetch_maps(client, page)
+            iso_latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+    return {"flask_result": summarize(result_latencies), "flask_iso": summarize(iso_latencies)}, errors
+
+
+def run(mappings_dirpath, n_queries=50, tolerance=0.8, trip_window=4, seed=0, flask=True, flask_cache=False):
+    """ Runs all the benchmarks, returns the results as a dict """
+    start = time.perf_counter()
+    data = load_planner_data(mappings_dirpath)
+    load_s = time.perf_counter() - start
+    fbi = FrontBackInterface(mappings_dirpath, cache=None)
+    queries = random_queries(data, n_queries, tolerance, trip_window, seed)
+
+    results = {}
+    logger.info("compute and get_route")
+    compute_results, routed = bench_compute(data, queries, tolerance, trip_window)
+    results.update(compute_results)
+    logger.info("times_to_stations")
+    results.update(bench_times_to_stations(fbi, queries, tolerance, trip_window))
+    logger.info("table operations")
+    results.update(bench_table_ops(data, queries[:max(1, n_queries // 5)], tolerance, trip_window))
+    flask_errors = 0
+    if flask:
+        logger.info("flask endpoints")
+        cwd = os.getcwd()
+        client, workdir = load_flask_app(mappings_dirpath, flask_cache)
+        try:
+            flask_results, flask_errors = bench_flask(client, data.index_station, routed, queries[:max(1, n_queries // 5)], tolerance)
+            results.update(flask_results)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    tt = data.stochastic_timetable
+    return {
+        "meta": {
+            "mappings_dirpath": os.path.abspath(mappings_dirpath),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "stations": data.n_stations,
+            "connections": len(tt),
+            "trips": len(tt.trip_ids),
+            "footpaths": int(data.adjacency_sparse.nnz - data.n_stations),
+            "queries": n_queries,
+            "tolerance": tolerance,
+            "trip_window": trip_window,
+            "seed": seed,
+            "load_s": load_s,
+            "flask_errors": flask_errors,
+        },
+        "benchmarks": results,
+    }
+
+
+def compare(results, baseline, max_slowdown):
+    """ Prints the median latencies next to the ones of a baseline run, returns the names of the regressions """
+    regressions = []
+    print(f"{'benchmark':20s}{'baseline p50':>14s}{'p50':>12s}{'ratio':>8s}", file=sys.stderr)
+    for name, summary in results["benchmarks"].items():
+        previous = baseline["benchmarks"].get(name)
+        if not previous or not previous.get("n") or not summary.get("n"):
+            continue
+        ratio = summary["p50_ms"] / max(previous["p50_ms"], 1e-9)
+        flag = "  slower" if ratio > max_slowdown else ""
+        print(f"{name:20s}{previous['p50_ms']:14.3f}{summary['p50_ms']:12.3f}{ratio:8.2f}{flag}", file=sys.stderr)
+        if ratio > max_slowdown:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--synthetic", type=int, metavar="STATIONS", help="benchmarks a synthetic network of this many stations instead")
+    parser.add_argument("--lines", type=int, help="lines of the synthetic network, stations/12 by default")
+    parser.add_argument("--trips-per-hour", type=float, default=6)
+    parser.add_argument("--footpath-radius", type=float, default=synthetic.WALKING_RADIUS)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--tolerance", type=float, default=0.8)
+    parser.add_argument("--trip-window", type=float, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-flask", action="store_true", help="skips the endpoints")
+    parser.add_argument("--flask-cache", action="store_true", help="keeps the query cache of the web server")
+    parser.add_argument("--out", help="writes the results to this file instead of stdout")
+    parser.add_argument("--compare", help="results of a previous run")
+    parser.add_argument("--max-slowdown", type=float, default=1.2)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    mappings_dirpath = args.mappings_dirpath
+    if args.synthetic:
+        mappings_dirpath = tempfile.mkdtemp(prefix="synthetic_")
+        synthetic.generate(mappings_dirpath, args.synthetic, args.lines or max(args.synthetic // 12, 1),
+                           trips_per_hour=args.trips_per_hour, footpath_radius=args.footpath_radius, seed=args.seed)
+    results = run(mappings_dirpath, args.queries, args.tolerance, args.trip_window, args.seed, not args.no_flask, args.flask_cache)
+    if args.synthetic:
+        shutil.rmtree(mappings_dirpath, ignore_errors=True)
+        results["meta"]["synthetic"] = {"stations": args.synthetic, "lines": args.lines or max(args.synthetic // 12, 1),
+                                        "trips_per_hour": args.trips_per_hour, "footpath_radius": args.footpath_radius}
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_slowdown):
+            sys.exit(1)
+
+
+if __name__=="__main__":
+    main()
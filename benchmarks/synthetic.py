@@ -0,0 +1,184 @@
+"""
+Generates a synthetic network in the format of saved_data/ (station mappings,
+bfkoordgeo.csv, footpaths, delay model, compiled timetable and lower bounds), so
+that the planner can be benchmarked without the SBB data. Stations are scattered
+around Zürich HB (which is always station 0), lines are chains of nearby stations
+served in both directions from 'first_hour' to 'last_hour'.
+
+    python -m benchmarks.synthetic synthetic_data --stations 1000 --lines 80 --trips-per-hour 6
+"""
+import argparse
+import os
+import pickle
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from footpaths import WALKING_RADIUS, FootpathIndex, build_footpaths
+from lower_bounds import LOWER_BOUNDS_FNAME, build_lower_bounds
+from timetable import N_BINS, N_DAYS, N_HOURS, TIMETABLE_DIRNAME, ColumnarTimetable
+
+CENTER = (8.540192, 47.378177) # (lon, lat) of Zürich HB
+KM_PER_DEGREE = 111.32
+TYPES = {
+    # type: (share of the lines, speed in km/h, mean delay in minutes)
+    "Zug": (0.2, 60., 1.5),
+    "Bus": (0.5, 20., 1.),
+    "Tram": (0.3, 18., 0.8),
+}
+RUSH_HOURS = (7, 8, 17, 18)
+
+
+def delay_cdf(mean_delay):
+    """ CDF over the 11 delay bins of an exponential delay distribution """
+    cdf = 1 - np.exp(-(np.arange(N_BINS) + .5) / mean_delay)
+    cdf[-1] = 1.
+    return cdf
+
+
+def synthetic_delay_model():
+    """ final_cdfs with longer delays at rush hours and shorter ones on weekends, and the general CDF """
+    final_cdfs = {}
+    for t, (_, _, mean_delay) in TYPES.items():
+        final_cdfs[t] = {}
+        for day in range(1, N_DAYS + 1):
+            weekend = 0.7 if day in (1, 7) else 1.
+            final_cdfs[t][day] = {hour: delay_cdf(mean_delay * weekend * (1.5 if hour in RUSH_HOURS else 1.)) for hour in range(N_HOURS)}
+    return final_cdfs, delay_cdf(np.mean([mean_delay for _, _, mean_delay in TYPES.values()]))
+
+
+def station_positions(n_stations, radius, rng):
+    """ (lon, lat) of the stations, denser towards the center; station 0 is the center """
+    distances = radius * np.sqrt(rng.random(n_stations)) ** 1.5
+    distances[0] = 0
+    angles = rng.random(n_stations) * 2 * np.pi
+    x, y = distances * np.cos(angles), distances * np.sin(angles)
+    lon = CENTER[0] + x / (KM_PER_DEGREE * np.cos(np.radians(CENTER[1])))
+    lat = CENTER[1] + y / KM_PER_DEGREE
+    return np.column_stack((lon, lat)), np.column_stack((x, y))
+
+
+def line_paths(xy, n_lines, stops_per_line, rng, n_neighbours=8):
+    """ Each line walks from a random station to one of the closest stations it did not visit yet """
+    tree = cKDTree(xy)
+    k = min(n_neighbours + 1, len(xy))
+    paths = []
+    for _ in range(n_lines):
+        path = [int(rng.integers(len(xy)))]
+        while len(path) < stops_per_line:
+            _, neighbours = tree.query(xy[path[-1]], k=k)
+            candidates = [int(s) for s in np.atleast_1d(neighbours) if s not in path]
+            if not candidates:
+                break
+            path.append(candidates[int(rng.integers(min(3, len(candidates))))])
+        if len(path) > 1:
+            paths.append(path)
+    return paths
+
+
+def generate_connections(xy, paths, date, trips_per_hour, first_hour, last_hour, final_cdfs, rng):
+    """ Connection dicts in the format of stochastic_timetable.pkl, for every trip of every line """
+    connections = []
+    types = list(TYPES)
+    shares = np.array([share for share, _, _ in TYPES.values()])
+    headway = 60. / trips_per_hour
+    for line, path in enumerate(paths):
+        t = types[rng.choice(len(types), p=shares / shares.sum())]
+        speed = TYPES[t][1]
+        # minutes between consecutive stops, plus a dwell time of one minute
+        hops = [max(1, int(round(np.hypot(*(xy[a] - xy[b])) / speed * 60))) for a, b in zip(path, path[1:])]
+        offset = rng.random() * headway
+        for direction, stops in enumerate((path, path[::-1])):
+            stop_hops = hops if direction == 0 else hops[::-1]
+            n_trips = int((last_hour - first_hour) * 60 / headway)
+            for k in range(n_trips):
+                departure = datetime.combine(date, datetime.min.time()) + timedelta(minutes=int(first_hour * 60 + offset + k * headway))
+                trip_id = f"synthetic:{line}:{direction}:{k}"
+                for a, b, hop in zip(stops, stops[1:], stop_hops):
+                    arrival = departure + timedelta(minutes=hop)
+                    c_day = arrival.isoweekday() % 7 + 1 # Spark's dayofweek, 1 (Sunday) to 7 (Saturday)
+                    connections.append({
+                        "trip_id": trip_id,
+                        "type": t,
+                        "departure_station": a,
+                        "arrival_station": b,
+                        "departure_timestamp": departure,
+                        "arrival_timestamp": arrival,
+                        "c_day": c_day,
+                        "c_hour": arrival.hour,
+                        "cdf": final_cdfs[t][c_day][arrival.hour],
+                    })
+                    departure = arrival + timedelta(minutes=1)
+    return connections
+
+
+def generate(out_dirpath, n_stations=1000, n_lines=80, stops_per_line=20, trips_per_hour=6, footpath_radius=WALKING_RADIUS,
+             radius=10., date=datetime(2019, 1, 2), first_hour=5, last_hour=24, seed=0, write_pickle=False):
+    """
+    Writes a synthetic network to 'out_dirpath', returns its compiled timetable. The footpath
+    density is set by 'footpath_radius' (km) and 'radius' (km, the extent of the network).
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dirpath, exist_ok=True)
+    lonlat, xy = station_positions(n_stations, radius, rng)
+    names = ["Zürich HB"] + [f"Synthetic {i:05d}" for i in range(1, n_stations)]
+    station_idx = {name: i for i, name in enumerate(names)}
+    index_station = dict(enumerate(names))
+
+    final_cdfs, general_cdf = synthetic_delay_model()
+    paths = line_paths(xy, n_lines, stops_per_line, rng)
+    connections = generate_connections(xy, paths, date.date() if isinstance(date, datetime) else date,
+                                       trips_per_hour, first_hour, last_hour, final_cdfs, rng)
+
+    for obj, fname in ((station_idx, "station_index.pkl"), (index_station, "index_station.pkl"), (list(TYPES), "type_list.pkl"),
+                       (final_cdfs, "final_cdfs.pkl"), (general_cdf.tolist(), "general_cdf.pkl")):
+        with open(os.path.join(out_dirpath, fname), "wb") as f:
+            pickle.dump(obj, f)
+    if write_pickle:
+        with open(os.path.join(out_dirpath, "stochastic_timetable.pkl"), "wb") as f:
+            pickle.dump(connections, f)
+    station_meta_df = pd.DataFrame({
+        "StationID": [f"{8500000 + i:07d}" for i in range(n_stations)],
+        "Longitude": lonlat[:, 0].round(6),
+        "Latitude": lonlat[:, 1].round(6),
+        "Height": 0,
+        "Remark": names,
+    })
+    # the planner drops the last line of bfkoordgeo.csv, which is empty in the SBB file
+    station_meta_df.to_csv(os.path.join(out_dirpath, "bfkoordgeo.csv"), index=False)
+    with open(os.path.join(out_dirpath, "bfkoordgeo.csv"), "a") as f:
+        f.write(",,,,\n")
+
+    station_coord = dict(zip(names, map(tuple, lonlat)))
+    adjacency_sparse = build_footpaths(station_coord, index_station, radius=footpath_radius)
+    sparse.save_npz(os.path.join(out_dirpath, "adjacency_sparse.npz"), adjacency_sparse)
+    timetable = ColumnarTimetable.from_connections(connections, list(TYPES), final_cdfs)
+    timetable.cdfs[-1] = general_cdf
+    timetable.save(os.path.join(out_dirpath, TIMETABLE_DIRNAME))
+    build_lower_bounds(timetable, FootpathIndex.from_adjacency(adjacency_sparse), os.path.join(out_dirpath, LOWER_BOUNDS_FNAME))
+    return timetable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dirpath", nargs="?", default="synthetic_data")
+    parser.add_argument("--stations", type=int, default=1000)
+    parser.add_argument("--lines", type=int, default=80)
+    parser.add_argument("--stops-per-line", type=int, default=20)
+    parser.add_argument("--trips-per-hour", type=float, default=6, help="trips per line and direction")
+    parser.add_argument("--footpath-radius", type=float, default=WALKING_RADIUS, help="km")
+    parser.add_argument("--radius", type=float, default=10., help="extent of the network, in km")
+    parser.add_argument("--date", default="2019-01-02", help="service day, YYYY-MM-DD")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pickle", action="store_true", help="also writes stochastic_timetable.pkl")
+    args = parser.parse_args()
+    timetable = generate(args.out_dirpath, args.stations, args.lines, args.stops_per_line, args.trips_per_hour, args.footpath_radius,
+                         args.radius, datetime.strptime(args.date, "%Y-%m-%d"), seed=args.seed, write_pickle=args.pickle)
+    print(f"generated {args.stations} stations, {len(timetable.trip_ids)} trips and {len(timetable)} connections in {args.out_dirpath}")
+
+
+if __name__=="__main__":
+    main()
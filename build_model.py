@@ -0,0 +1,511 @@
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from datastore import building
+from footpaths import build_footpaths, haversine
+from lower_bounds import save_lower_bounds
+from timetable import N_BINS, N_DAYS, N_HOURS, TIMETABLE_DIRNAME, ColumnarTimetable
+
+logger = logging.getLogger(__name__)
+
+ZURICH_HB = "Zürich HB"
+ZURICH_RADIUS = 10. # km, stations further from Zürich HB are filtered out
+N_HOUR_CLUSTERS = 6
+WEEKEND_DAYS = (1, 7) # Sunday and Saturday, days are labeled 1 (Sunday) to 7 (Saturday) as in Spark's dayofweek
+DELAY_COUNTS_FNAME = "delay_counts.npz"
+
+COLUMNS = ["BETRIEBSTAG", "FAHRT_BEZEICHNER", "PRODUKT_ID", "HALTESTELLEN_NAME", "ANKUNFTSZEIT",
+           "AN_PROGNOSE", "AN_PROGNOSE_STATUS", "ABFAHRTSZEIT", "VERKEHRSMITTEL_TEXT"]
+
+
+def zurich_stations(station_meta_df, radius=ZURICH_RADIUS):
+    """ Names of the stations of the metadata that are at most 'radius' km from Zürich HB, in the order of the metadata """
+    hb = station_meta_df[station_meta_df.Remark == ZURICH_HB].iloc[0]
+    distances = haversine(station_meta_df.Longitude.values, station_meta_df.Latitude.values, hb.Longitude, hb.Latitude)
+    return station_meta_df.Remark[distances <= radius].tolist()
+
+
+def spark_dayofweek(timestamps):
+    """ Day of the week labeled 1 (Sunday) to 7 (Saturday), as Spark's dayofweek """
+    return (timestamps.dt.dayofweek.values + 1) % 7 + 1
+
+
+def delay_bins(delays):
+    """
+    Bins of the delays (in minutes) clipped to [0,10], with the buckets centered on
+    whole minutes that the notebook used for its histograms (-0.5, 0.5, ..., 10.5)
+    """
+    return np.floor(np.clip(delays, 0, 10) + 0.5).astype(np.int64)
+
+
+def general_delay_bins(delays):
+    """ Bins of the general CDF of the notebook: delays rounded up to whole minutes in [0,10] """
+    return np.where(delays <= 0, 0, np.where(delays < 10, np.ceil(delays), 10)).astype(np.int64)
+
+
+class DelayCounts:
+    """
+    Sample counts of the arrival delays, per transport type and (day of week, hour),
+    day of year and month, from which all the histograms of the delay model derive.
+    Counts are additive, so the counts of several files are merged by summing them.
+    """
+
+    def __init__(self):
+        self.by_hour = {} # type -> (7, 24, 11) counts
+        self.by_day_of_year = {} # type -> (367, 11) counts
+        self.by_month = {} # type -> (12, 11) counts
+        self.general = np.zeros(N_BINS, dtype=np.int64) # measured ('REAL') arrivals only
+        self.subtypes = set()
+
+    def _type_counts(self, t):
+        if t not in self.by_hour:
+            self.by_hour[t] = np.zeros((N_DAYS, N_HOURS, N_BINS), dtype=np.int64)
+            self.by_day_of_year[t] = np.zeros((367, N_BINS), dtype=np.int64)
+            self.by_month[t] = np.zeros((12, N_BINS), dtype=np.int64)
+        return self.by_hour[t], self.by_day_of_year[t], self.by_month[t]
+
+    def add_arrivals(self, types, expected, actual, subtypes, measured):
+        """ Counts arrivals (pandas Series), expected and actual arrivals are timestamps """
+        delays = (actual - expected).dt.total_seconds().values / 60
+        general = delays[measured]
+        self.general += np.bincount(general_delay_bins(general), minlength=N_BINS)
+        bins = delay_bins(delays)
+        days, hours = spark_dayofweek(expected) - 1, expected.dt.hour.values
+        days_of_year, months = expected.dt.dayofyear.values, expected.dt.month.values - 1
+        types = types.values
+        for t in np.unique(types):
+            is_t = types == t
+            by_hour, by_day_of_year, by_month = self._type_counts(t)
+            np.add.at(by_hour, (days[is_t], hours[is_t], bins[is_t]), 1)
+            np.add.at(by_day_of_year, (days_of_year[is_t], bins[is_t]), 1)
+            np.add.at(by_month, (months[is_t], bins[is_t]), 1)
+        self.subtypes.update(zip(types.tolist(), subtypes.values.tolist()))
+
+    def merge(self, other):
+        for t in other.by_hour:
+            by_hour, by_day_of_year, by_month = self._type_counts(t)
+            by_hour += other.by_hour[t]
+            by_day_of_year += other.by_day_of_year[t]
+            by_month += other.by_month[t]
+        self.general += other.general
+        self.subtypes |= other.subtypes
+
+    @property
+    def type_list(self):
+        return sorted(self.by_hour)
+
+    def save(self, fpath):
+        """ Saves the counts as arrays indexed by type_list, so that they can be merged with later data """
+        types = self.type_list
+        replace_atomically(fpath, lambda f: np.savez(f, types=np.array(types, dtype=str),
+                 by_hour=np.array([self.by_hour[t] for t in types]).reshape(len(types), N_DAYS, N_HOURS, N_BINS),
+                 by_day_of_year=np.array([self.by_day_of_year[t] for t in types]).reshape(len(types), 367, N_BINS),
+                 by_month=np.array([self.by_month[t] for t in types]).reshape(len(types), 12, N_BINS),
+                 general=self.general,
+                 subtypes=np.array(sorted(self.subtypes), dtype=str).reshape(-1, 2)))
+
+    @classmethod
+    def load(cls, fpath):
+        counts = cls()
+        with np.load(fpath) as saved:
+            for i, t in enumerate(saved["types"].tolist()):
+                counts.by_hour[t] = saved["by_hour"][i].copy()
+                counts.by_day_of_year[t] = saved["by_day_of_year"][i].copy()
+                counts.by_month[t] = saved["by_month"][i].copy()
+            counts.general = saved["general"].copy()
+            counts.subtypes = {tuple(subtype) for subtype in saved["subtypes"].tolist()}
+        return counts
+
+    @classmethod
+    def from_histograms(cls, mappings_dirpath):
+        """
+        Approximate counts of a directory without delay_counts.npz (e.g. the saved_data
+        of the notebook), rebuilt from its histogram pickles. These only keep the sample
+        sizes per type, hour, day of week, day of year and month: the samples of every
+        (day of week, hour) are estimated as n(day) * n(hour) / n and distributed as its
+        final histogram, and the general counts are those of all the types.
+        """
+        counts = cls()
+        final_histograms = load(mappings_dirpath, "final_histograms.pkl")
+        transport_hist_dict = load(mappings_dirpath, "transport_hist_dict.pkl")
+        transport_n_hist_dict = load(mappings_dirpath, "transport_n_hist_dict.pkl")
+        hours_n_histograms = load(mappings_dirpath, "hours_n_histograms.pkl")
+        day_of_week_n_histograms = load(mappings_dirpath, "day_of_week_n_histograms.pkl")
+        day_of_year_histograms = load(mappings_dirpath, "day_of_year_histograms.pkl")
+        day_of_year_n_histograms = load(mappings_dirpath, "day_of_year_n_histograms.pkl")
+        month_histograms = load(mappings_dirpath, "month_histograms.pkl")
+        month_n_histograms = load(mappings_dirpath, "month_n_histograms.pkl")
+        for t, n in transport_n_hist_dict.items():
+            by_hour, by_day_of_year, by_month = counts._type_counts(t)
+            n_hours = np.array([hours_n_histograms[h].get(t, 0) for h in range(N_HOURS)], dtype=np.float64)
+            n_days = np.array([day_of_week_n_histograms[d].get(t, 0) for d in range(N_DAYS)], dtype=np.float64)
+            samples = np.outer(n_days, n_hours) / max(n, 1)
+            if t in final_histograms:
+                for d in range(N_DAYS):
+                    for h in range(N_HOURS):
+                        by_hour[d, h] = np.rint(np.asarray(final_histograms[t][d + 1][h]) * samples[d, h])
+            for d, histograms, n_histograms in zip(load(mappings_dirpath, "day_of_year_list.pkl"), day_of_year_histograms, day_of_year_n_histograms):
+                if t in histograms:
+                    by_day_of_year[d] = np.rint(np.asarray(histograms[t]) * n_histograms[t])
+            for m in range(12):
+                if t in month_histograms[m]:
+                    by_month[m] = np.rint(np.asarray(month_histograms[m][t]) * month_n_histograms[m][t])
+            counts.general += np.rint(np.asarray(transport_hist_dict[t]) * n).astype(np.int64)
+        counts.subtypes = {tuple(subtype) for subtype in load(mappings_dirpath, "subtypes_list.pkl")}
+        return counts
+
+
+def normalized(counts):
+    """ Normalizes histograms along the last axis, empty ones assume Pr(delay = 0) = 1 """
+    counts = np.asarray(counts, dtype=np.float64)
+    n = counts.sum(axis=-1, keepdims=True)
+    empty = np.zeros(counts.shape[-1])
+    empty[0] = 1
+    return np.where(n > 0, counts / np.where(n > 0, n, 1), empty)
+
+
+def kmeans(points, n_clusters, n_init=10, n_iter=300, seed=0):
+    """ Lloyd's k-means with k-means++ initialization, returns the cluster of every point """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(np.unique(points, axis=0)))
+    best_labels, best_inertia = None, np.inf
+    for _ in range(n_init):
+        centers = [points[rng.integers(len(points))]]
+        for _ in range(1, n_clusters):
+            distances = np.min([((points - center)**2).sum(axis=1) for center in centers], axis=0)
+            centers.append(points[rng.choice(len(points), p=distances / distances.sum())])
+        centers = np.array(centers)
+        for _ in range(n_iter):
+            labels = ((points[:, None, :] - centers[None, :, :])**2).sum(axis=2).argmin(axis=1)
+            new_centers = np.array([points[labels == k].mean(axis=0) if np.any(labels == k) else centers[k] for k in range(n_clusters)])
+            if np.allclose(new_centers, centers):
+                break
+            centers = new_centers
+        inertia = ((points - centers[labels])**2).sum()
+        if inertia < best_inertia:
+            best_labels, best_inertia = labels, inertia
+    return best_labels
+
+
+def cluster_hours(counts, n_clusters=N_HOUR_CLUSTERS):
+    """ Clusters the hours of the day of each type by the similarity of their delay distributions """
+    return {t: kmeans(normalized(by_hour.sum(axis=0)), n_clusters).tolist() for t, by_hour in counts.by_hour.items()}
+
+
+def hour_groups(hour_clusters):
+    """
+    The (weekend flag, hour cluster) groups of a type, as (days, hours) masks:
+    all the (day of week, hour) of a group share the same delay distribution
+    """
+    weekend = np.isin(np.arange(1, N_DAYS + 1), WEEKEND_DAYS)
+    hour_clusters = np.array(hour_clusters)
+    return [(weekend == is_weekend, hour_clusters == cluster) for is_weekend in (False, True) for cluster in np.unique(hour_clusters)]
+
+
+def group_histogram(by_hour, days, hours):
+    """ Normalized delay histogram of the counts of a (days, hours) group """
+    return normalized(by_hour[days][:, hours].sum(axis=(0, 1)))
+
+
+def final_histograms(counts, hour_cluster_dict):
+    """
+    Delay distribution of every (type, day of week, hour), computed from the counts
+    of its (type, weekend flag, hour cluster): returns {type: (7, 24, 11) array}
+    """
+    histograms = {}
+    for t in counts.type_list:
+        histograms[t] = np.empty((N_DAYS, N_HOURS, N_BINS))
+        for days, hours in hour_groups(hour_cluster_dict[t]):
+            histograms[t][np.ix_(days, hours)] = group_histogram(counts.by_hour[t], days, hours)
+    return histograms
+
+
+def final_cdfs_from_histograms(histograms):
+    """ final_cdfs in the format of the notebook: {type: {day: {hour: CDF}}} """
+    return {t: {d + 1: {h: np.cumsum(histograms[t][d, h]) for h in range(N_HOURS)} for d in range(N_DAYS)} for t in histograms}
+
+
+def scan_file(args):
+    """
+    Streams one istdaten file in chunks and returns the DelayCounts of its arrivals
+    in the Zurich area, the names of the stations it observed, and its stop events
+    on the days of the timetable
+    """
+    fpath, stations, timetable_dates, chunksize = args
+    stations, timetable_dates = set(stations), set(timetable_dates)
+    counts, observed, stop_events = DelayCounts(), set(), []
+    for chunk in pd.read_csv(fpath, sep=";", usecols=COLUMNS, dtype=str, chunksize=chunksize):
+        chunk = chunk[chunk.HALTESTELLEN_NAME.isin(stations)]
+        observed.update(chunk.HALTESTELLEN_NAME.unique().tolist())
+        expected = pd.to_datetime(chunk.ANKUNFTSZEIT, format="%d.%m.%Y %H:%M", errors="coerce")
+        actual = pd.to_datetime(chunk.AN_PROGNOSE, format="%d.%m.%Y %H:%M:%S", errors="coerce")
+        is_arrival = (chunk.PRODUKT_ID.notna() & chunk.VERKEHRSMITTEL_TEXT.notna() & expected.notna() & actual.notna()).values
+        arrivals = chunk[is_arrival]
+        counts.add_arrivals(arrivals.PRODUKT_ID, expected[is_arrival], actual[is_arrival], arrivals.VERKEHRSMITTEL_TEXT,
+                            (arrivals.AN_PROGNOSE_STATUS == "REAL").values)
+        in_timetable = chunk.BETRIEBSTAG.isin(timetable_dates).values
+        if in_timetable.any():
+            stop_events.append(pd.DataFrame({
+                "date": chunk.BETRIEBSTAG[in_timetable],
+                "trip_id": chunk.FAHRT_BEZEICHNER[in_timetable],
+                "type": chunk.PRODUKT_ID[in_timetable],
+                "station": chunk.HALTESTELLEN_NAME[in_timetable],
+                "arrival": expected[in_timetable],
+                "departure": pd.to_datetime(chunk.ABFAHRTSZEIT[in_timetable], format="%d.%m.%Y %H:%M", errors="coerce"),
+            }))
+    return fpath, counts, observed, pd.concat(stop_events) if stop_events else None
+
+
+def build_connections(stop_events, station_idx, final_cdfs, general_cdf):
+    """
+    Connections between the consecutive stops of every trip (ordered by arrival, the
+    first stop has none), as connection dicts in the format of stochastic_timetable.pkl.
+    Trip ids are prefixed with the date when the timetable covers several days.
+    """
+    stop_events = stop_events[stop_events.station.isin(station_idx)].copy()
+    several_days = stop_events.date.nunique() > 1
+    stop_events["trip_key"] = stop_events.date + "/" + stop_events.trip_id if several_days else stop_events.trip_id
+    stop_events = stop_events.sort_values(["trip_key", "arrival"], na_position="first", kind="stable")
+    following = stop_events.groupby("trip_key", sort=False)[["station", "arrival"]].shift(-1)
+    stop_events["arrival_station"] = following.station
+    stop_events["arrival_timestamp"] = following.arrival
+    stop_events = stop_events.dropna(subset=["departure", "arrival_timestamp"])
+    c_days = spark_dayofweek(stop_events.arrival_timestamp)
+    c_hours = stop_events.arrival_timestamp.dt.hour.values
+    connections = []
+    for row, c_day, c_hour in zip(stop_events.itertuples(index=False), c_days.tolist(), c_hours.tolist()):
+        cdf = final_cdfs[row.type][c_day][c_hour] if row.type in final_cdfs else general_cdf
+        connections.append({
+            "trip_id": row.trip_key,
+            "type": row.type,
+            "departure_station": station_idx[row.station],
+            "arrival_station": station_idx[row.arrival_station],
+            "departure_timestamp": row.departure.to_pydatetime(),
+            "arrival_timestamp": row.arrival_timestamp.to_pydatetime(),
+            "c_day": c_day,
+            "c_hour": c_hour,
+            "cdf": cdf,
+        })
+    return connections
+
+
+def replace_atomically(fpath, write):
+    """ Writes 'fpath' with write(f) through a temporary file, so that a running planner never reads a partial file """
+    tmp_path = fpath + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, fpath)
+
+
+def dump(obj, out_dirpath, fname):
+    replace_atomically(os.path.join(out_dirpath, fname), lambda f: pickle.dump(obj, f))
+
+
+def load(out_dirpath, fname):
+    with open(os.path.join(out_dirpath, fname), "rb") as f:
+        return pickle.load(f)
+
+
+def save_histograms(counts, out_dirpath):
+    """ Writes the summary histogram pickles of the notebook (per type, hour, day and month), derived from the counts """
+    types = counts.type_list
+    by_type = {t: counts.by_hour[t].sum(axis=(0, 1)) for t in types}
+    dump({t: normalized(by_type[t]) for t in types}, out_dirpath, "transport_hist_dict.pkl")
+    dump({t: by_type[t].sum() for t in types}, out_dirpath, "transport_n_hist_dict.pkl")
+    hours = {t: counts.by_hour[t].sum(axis=0) for t in types}
+    dump([{t: normalized(hours[t][h]) for t in types} for h in range(N_HOURS)], out_dirpath, "hours_histograms.pkl")
+    dump([{t: hours[t][h].sum() for t in types} for h in range(N_HOURS)], out_dirpath, "hours_n_histograms.pkl")
+    days = {t: counts.by_hour[t].sum(axis=1) for t in types}
+    dump([{t: normalized(days[t][d]) for t in types} for d in range(N_DAYS)], out_dirpath, "day_of_week_histograms.pkl")
+    dump([{t: days[t][d].sum() for t in types} for d in range(N_DAYS)], out_dirpath, "day_of_week_n_histograms.pkl")
+    dump(list(range(1, N_DAYS + 1)), out_dirpath, "day_of_week_list.pkl")
+    day_of_year_list = sorted({d for t in types for d in np.flatnonzero(counts.by_day_of_year[t].sum(axis=1)).tolist()})
+    dump([{t: normalized(counts.by_day_of_year[t][d]) for t in types} for d in day_of_year_list], out_dirpath, "day_of_year_histograms.pkl")
+    dump([{t: counts.by_day_of_year[t][d].sum() for t in types} for d in day_of_year_list], out_dirpath, "day_of_year_n_histograms.pkl")
+    dump(day_of_year_list, out_dirpath, "day_of_year_list.pkl")
+    dump([{t: normalized(counts.by_month[t][m]) for t in types} for m in range(12)], out_dirpath, "month_histograms.pkl")
+    dump([{t: counts.by_month[t][m].sum() for t in types} for m in range(12)], out_dirpath, "month_n_histograms.pkl")
+    dump(sorted(counts.subtypes), out_dirpath, "subtypes_list.pkl")
+
+
+def general_cdf_from_counts(counts):
+    """ General CDF of all measured delays, rounded to 4 decimals as in the notebook """
+    return [round(float(p), 4) for p in np.cumsum(normalized(counts.general))]
+
+
+def scan_files(csv_paths, stations, timetable_dates=(), processes=None, chunksize=500000):
+    """ Scans the files in parallel (one process per file) and merges their counts, observed stations and stop events """
+    counts, observed, stop_events = DelayCounts(), set(), []
+    tasks = [(fpath, stations, timetable_dates, chunksize) for fpath in csv_paths]
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    with multiprocessing.get_context("spawn" if os.name == "nt" else "fork").Pool(processes) as pool:
+        for fpath, file_counts, file_observed, file_stop_events in pool.imap_unordered(scan_file, tasks):
+            logger.info("scanned %s", fpath)
+            counts.merge(file_counts)
+            observed |= file_observed
+            if file_stop_events is not None:
+                stop_events.append(file_stop_events)
+    return counts, observed, stop_events
+
+
+def build(csv_paths, out_dirpath, station_meta_path, timetable_dates=None, processes=None, chunksize=500000):
+    """
+    Builds the delay model and the timetable from istdaten csv files (bz2 compressed
+    or not) in one pass over the data: each file is streamed by its own process,
+    and all the histograms, the hour clusters and the CDFs derive from the merged
+    sample counts. Every file is replaced atomically, and a planner serving
+    'out_dirpath' only reloads it once all of them are written.
+    """
+    os.makedirs(out_dirpath, exist_ok=True)
+    with building(out_dirpath):
+        return _build(csv_paths, out_dirpath, station_meta_path, timetable_dates, processes, chunksize)
+
+
+def _build(csv_paths, out_dirpath, station_meta_path, timetable_dates, processes, chunksize):
+    start = time.perf_counter()
+    station_meta_df = pd.read_csv(station_meta_path).head(-1)
+    stations = zurich_stations(station_meta_df)
+    csv_paths = sorted(csv_paths)
+    if not timetable_dates:
+        # the first service day of the data
+        first = pd.read_csv(csv_paths[0], sep=";", usecols=["BETRIEBSTAG"], dtype=str, nrows=1000)
+        timetable_dates = [min(first.BETRIEBSTAG, key=lambda date: pd.to_datetime(date, format="%d.%m.%Y"))]
+
+    counts, observed, stop_events = scan_files(csv_paths, stations, timetable_dates, processes, chunksize)
+
+    observed_stations = [station for station in stations if station in observed]
+    station_idx = {station: i for i, station in enumerate(observed_stations)}
+    index_station = {i: station for i, station in enumerate(observed_stations)}
+    type_list = counts.type_list
+    hour_cluster_dict = cluster_hours(counts)
+    histograms = final_histograms(counts, hour_cluster_dict)
+    final_cdfs = final_cdfs_from_histograms(histograms)
+    general_cdf = general_cdf_from_counts(counts)
+
+    dump(station_idx, out_dirpath, "station_index.pkl")
+    dump(index_station, out_dirpath, "index_station.pkl")
+    dump(type_list, out_dirpath, "type_list.pkl")
+    dump(final_cdfs, out_dirpath, "final_cdfs.pkl")
+    dump(general_cdf, out_dirpath, "general_cdf.pkl")
+    dump(hour_cluster_dict, out_dirpath, "hour_cluster_dict.pkl")
+    dump({t: {d + 1: {h: histograms[t][d, h] for h in range(N_HOURS)} for d in range(N_DAYS)} for t in type_list},
+         out_dirpath, "final_histograms.pkl")
+    save_histograms(counts, out_dirpath)
+    counts.save(os.path.join(out_dirpath, DELAY_COUNTS_FNAME))
+    if os.path.abspath(station_meta_path) != os.path.abspath(os.path.join(out_dirpath, "bfkoordgeo.csv")):
+        with open(station_meta_path, "rb") as station_meta:
+            replace_atomically(os.path.join(out_dirpath, "bfkoordgeo.csv"), lambda f: shutil.copyfileobj(station_meta, f))
+
+    station_coord = pd.Series(list(zip(station_meta_df.Longitude,station_meta_df.Latitude)), index=station_meta_df.Remark).to_dict()
+    adjacency_sparse = build_footpaths(station_coord, index_station)
+    replace_atomically(os.path.join(out_dirpath, "adjacency_sparse.npz"), lambda f: sparse.save_npz(f, adjacency_sparse))
+
+    connections = build_connections(pd.concat(stop_events), station_idx, final_cdfs, general_cdf) if stop_events else []
+    timetable = ColumnarTimetable.from_connections(connections, type_list, final_cdfs)
+    timetable.cdfs[-1] = general_cdf
+    # a new version of the compiled timetable, the planner keeps mapping the previous one until it reloads
+    timetable.save(os.path.join(out_dirpath, TIMETABLE_DIRNAME))
+    save_lower_bounds(out_dirpath)
+    logger.info("built the model of %d stations and the timetable of %s (%d connections) in %.1f s",
+                len(station_idx), ", ".join(timetable_dates), len(connections), time.perf_counter() - start)
+    return timetable
+
+
+def update(csv_paths, mappings_dirpath="saved_data", processes=None, chunksize=500000):
+    """
+    Merges the arrivals of new istdaten files (typically the last day) into the
+    delay model of 'mappings_dirpath', without rescanning the history: the new
+    counts are added to delay_counts.npz, the hour clusters are kept, and only the
+    CDFs of the (type, weekend flag, hour cluster) groups that received new samples
+    are recomputed. The CDF matrix of the compiled timetable is replaced last, a
+    running planner swaps it in without reloading the timetable. Returns the number
+    of updated groups. A directory without delay_counts.npz starts from counts
+    approximated from its histogram pickles (see DelayCounts.from_histograms).
+    """
+    with building(mappings_dirpath):
+        return _update(csv_paths, mappings_dirpath, processes, chunksize)
+
+
+def _update(csv_paths, mappings_dirpath, processes, chunksize):
+    start = time.perf_counter()
+    counts_fpath = os.path.join(mappings_dirpath, DELAY_COUNTS_FNAME)
+    if os.path.exists(counts_fpath):
+        counts = DelayCounts.load(counts_fpath)
+    else:
+        try:
+            counts = DelayCounts.from_histograms(mappings_dirpath)
+        except FileNotFoundError as e:
+            raise SystemExit(f"{mappings_dirpath} has neither {DELAY_COUNTS_FNAME} nor the histograms to rebuild it from ({e.filename}), "
+                             "run a full build first")
+        logger.warning("%s has no %s, starting from approximate counts rebuilt from its histograms", mappings_dirpath, DELAY_COUNTS_FNAME)
+    hour_cluster_dict = load(mappings_dirpath, "hour_cluster_dict.pkl")
+    final_cdfs = load(mappings_dirpath, "final_cdfs.pkl")
+    histograms = load(mappings_dirpath, "final_histograms.pkl")
+    station_meta_df = pd.read_csv(os.path.join(mappings_dirpath, "bfkoordgeo.csv")).head(-1)
+    new_counts, _, _ = scan_files(sorted(csv_paths), zurich_stations(station_meta_df), (), processes, chunksize)
+    counts.merge(new_counts)
+
+    # the CDFs are written to the version of the timetable that is loaded here
+    timetable_dirpath = os.path.realpath(os.path.join(mappings_dirpath, TIMETABLE_DIRNAME))
+    compiled = os.path.exists(os.path.join(timetable_dirpath, "meta.json"))
+    if compiled:
+        timetable = ColumnarTimetable.load(timetable_dirpath)
+        cdfs = timetable.cdfs.copy()
+        type_index = {t: i for i, t in enumerate(timetable.types[:timetable.n_modeled_types()])}
+
+    n_updated = 0
+    for t in new_counts.type_list:
+        if t not in hour_cluster_dict:
+            logger.warning("no hour clusters for the new type %s, its delays are only modeled after a full build", t)
+            continue
+        for days, hours in hour_groups(hour_cluster_dict[t]):
+            if not new_counts.by_hour[t][days][:, hours].any():
+                continue
+            n_updated += 1
+            histogram = group_histogram(counts.by_hour[t], days, hours)
+            cdf = np.cumsum(histogram)
+            for d in np.flatnonzero(days) + 1:
+                for h in np.flatnonzero(hours):
+                    histograms[t][d][h], final_cdfs[t][d][h] = histogram, cdf
+                    if compiled and t in type_index:
+                        cdfs[ColumnarTimetable.cdf_row(type_index[t], d, h)] = cdf
+    general_cdf = general_cdf_from_counts(counts)
+
+    counts.save(os.path.join(mappings_dirpath, DELAY_COUNTS_FNAME))
+    dump(histograms, mappings_dirpath, "final_histograms.pkl")
+    dump(final_cdfs, mappings_dirpath, "final_cdfs.pkl")
+    dump(general_cdf, mappings_dirpath, "general_cdf.pkl")
+    save_histograms(counts, mappings_dirpath)
+    if compiled:
+        cdfs[-1] = general_cdf
+        replace_atomically(os.path.join(timetable_dirpath, "cdfs.npy"), lambda f: np.save(f, cdfs))
+    logger.info("updated %d delay distributions of %s in %.1f s", n_updated, mappings_dirpath, time.perf_counter() - start)
+    return n_updated
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Builds the delay model and the timetable from SBB istdaten csv files, without Spark")
+    parser.add_argument("csv_paths", nargs="+", help="istdaten files or glob patterns, e.g. '/datasets/sbb/2019/01/*.csv.bz2'")
+    parser.add_argument("--out", default="saved_data", help="directory the planner loads")
+    parser.add_argument("--update", action="store_true", help="merges the files into the delay model of --out instead of rebuilding everything")
+    parser.add_argument("--metadata", default="metadata/bfkoordgeo.csv", help="station coordinates")
+    parser.add_argument("--timetable-dates", nargs="+", help="service days of the timetable (dd.mm.yyyy), the first day of the data by default")
+    parser.add_argument("--processes", type=int, help="number of files scanned in parallel, all cores by default")
+    parser.add_argument("--chunksize", type=int, default=500000, help="rows per chunk")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    csv_paths = [fpath for pattern in args.csv_paths for fpath in (glob.glob(pattern) or [pattern])]
+    if args.update:
+        update(csv_paths, args.out, args.processes, args.chunksize)
+    else:
+        build(csv_paths, args.out, args.metadata, args.timetable_dates, args.processes, args.chunksize)
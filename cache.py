@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+BUSIEST_ORIGINS = ["Zürich HB", "Zürich Stadelhofen", "Zürich Oerlikon", "Zürich Flughafen"]
+ISOCHRONE_TOLERANCES = [0.5, 0.75, 0.9, 1.0] # the ones of the /iso page
+
+
+def version_key(version):
+    """ Short hash of the signature of the data files, so that results of older data are never served """
+    return hashlib.sha1(repr(version).encode()).hexdigest()[:16]
+
+
+class QueryCache:
+    """
+    LRU cache of query results, keyed on (kind, origin, destination, departure time
+    bucket, tolerance, trip_window, data version). Results are stored pickled: a
+    hit returns a fresh copy that the caller may modify, and the memory used is
+    the size of the pickles, bounded by 'max_bytes'. With 'disk_dirpath', results
+    are also written there (one file per key), so that they survive restarts and
+    can be precomputed offline. The disk tier is neither bounded nor evicted: with
+    'disk_writes' False it is only read, e.g. by a server answering arbitrary
+    queries from the results precomputed by this module.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=256 * 2**20, disk_dirpath=None, bucket_minutes=1, disk_writes=True):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dirpath = disk_dirpath
+        self.disk_writes = disk_writes
+        self.bucket_minutes = bucket_minutes
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dirpath is not None and disk_writes:
+            os.makedirs(disk_dirpath, exist_ok=True)
+
+    def key(self, kind, origin, destination, departure_time, tolerance, trip_window, version):
+        """ Cache key of a query, departure times are floored to 'bucket_minutes' """
+        minutes = departure_time.hour * 60 + departure_time.minute
+        midnight = departure_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        bucket = midnight + timedelta(minutes=minutes - minutes % self.bucket_minutes)
+        return (kind, origin, destination, bucket.isoformat(), round(float(tolerance), 4), trip_window, version_key(version))
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dirpath, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl")
+
+    def get(self, key, default=None):
+        """ Returns a copy of the result cached for 'key', 'default' on a miss """
+        with self._lock:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return pickle.loads(blob)
+        if self.disk_dirpath is not None:
+            try:
+                with open(self._disk_path(key), "rb") as cached:
+                    blob = cached.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self._insert(key, blob)
+                with self._lock:
+                    self.disk_hits += 1
+                return pickle.loads(blob)
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """ Caches 'value' for 'key' (in memory, and on disk if enabled and writable) """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._insert(key, blob)
+        if self.disk_dirpath is not None and self.disk_writes:
+            path = self._disk_path(key)
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as cached:
+                cached.write(blob)
+            os.replace(tmp_path, path) # readers never see a partial file
+
+    def _insert(self, key, blob):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._n_bytes -= len(previous)
+            self._entries[key] = blob
+            self._n_bytes += len(blob)
+            while len(self._entries) > self.max_entries or (self._n_bytes > self.max_bytes and len(self._entries) > 1):
+                _, evicted = self._entries.popitem(last=False)
+                self._n_bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """ Empties the memory tier (the disk tier is kept) """
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+
+    def stats(self):
+        """ Counters to size the cache """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._n_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def precompute_isochrones(fbi, origins=BUSIEST_ORIGINS, departure_times=(), tolerances=ISOCHRONE_TOLERANCES, trip_window=4):
+    """
+    Computes the times to all stations from each origin at each departure time,
+    for all tolerances, so that they are cached by the interface (and on disk if
+    its cache has a disk tier). Unknown origins are skipped.
+    """
+    n_queries = 0
+    for origin in origins:
+        if origin not in fbi.station_idx:
+            logger.warning("skipping unknown origin %s", origin)
+            continue
+        for departure_time in departure_times:
+            fbi.times_to_stations_by_tolerance(fbi.station_idx[origin], departure_time, tolerances, trip_window=trip_window)
+            n_queries += 1
+    return n_queries
+
+
+if __name__=="__main__":
+    from interface import FrontBackInterface
+
+    parser = argparse.ArgumentParser(description="Precomputes the isochrones of the busiest origins into an on-disk query cache")
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--cache-dir", default="query_cache", help="on-disk tier, should be outside of the data directory")
+    parser.add_argument("--origins", nargs="+", default=BUSIEST_ORIGINS)
+    parser.add_argument("--date", default="2019-01-02")
+    parser.add_argument("--times", nargs="+", default=["12:00"], help="departure times (HH:MM)")
+    parser.add_argument("--tolerances", nargs="+", type=float, default=ISOCHRONE_TOLERANCES)
+    parser.add_argument("--trip-window", type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    fbi = FrontBackInterface(args.mappings_dirpath, cache=QueryCache(disk_dirpath=args.cache_dir))
+    departure_times = [datetime.strptime(args.date + " " + t, "%Y-%m-%d %H:%M") for t in args.times]
+    n_queries = precompute_isochrones(fbi, args.origins, departure_times, args.tolerances, args.trip_window)
+    print("precomputed", n_queries, "isochrone queries,", fbi.cache.stats())
@@ -0,0 +1,199 @@
+import logging
+import os
+import pickle
+import resource
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from footpaths import FootpathIndex
+from lower_bounds import LOWER_BOUNDS_FNAME, load_lower_bounds
+from station_search import StationSearch
+from timetable import TIMETABLE_DIRNAME, VERSIONS_SUFFIX, is_complete, load_timetable
+
+logger = logging.getLogger(__name__)
+
+PlannerData = namedtuple("PlannerData", [
+    "station_idx", # station name -> index
+    "index_station", # index -> station name
+    "stochastic_timetable", # ColumnarTimetable
+    "adjacency_sparse", # walking times (in minutes) between close stations
+    "footpaths", # FootpathIndex built from adjacency_sparse
+    "station_coord", # station name -> (lon, lat)
+    "station_meta_df", # content of bfkoordgeo.csv
+    "station_search", # StationSearch of the station names and coordinates
+    "lower_bounds", # travel time lower bounds between stations (None if not built)
+    "n_stations",
+    "version", # signature of the files the data was loaded from
+])
+
+# Files the snapshot is built from, besides the compiled timetable: when neither them
+# nor the timetable columns changed (e.g. after build_model.update), only the CDF
+# matrix is swapped into the snapshot
+CDFS_PATH = os.path.join(TIMETABLE_DIRNAME, "cdfs.npy")
+# Present while build_model.py writes the directory, the snapshot is not reloaded meanwhile
+BUILDING_FNAME = "BUILDING"
+SNAPSHOT_FILES = {"station_index.pkl", "index_station.pkl", "adjacency_sparse.npz", "bfkoordgeo.csv", "stochastic_timetable.pkl", LOWER_BOUNDS_FNAME}
+
+
+@contextmanager
+def building(mappings_dirpath):
+    """
+    Marks 'mappings_dirpath' as being written for the duration of the context: running
+    planners keep serving their snapshot until all the files are written, instead of
+    loading a mix of old and new ones
+    """
+    fpath = os.path.join(mappings_dirpath, BUILDING_FNAME)
+    with open(fpath, "w") as marker:
+        marker.write(str(os.getpid()))
+    try:
+        yield
+    finally:
+        os.remove(fpath)
+
+
+def depickle_mappings(mappings_dirpath="saved_data"):
+    """ Depickles the index/name station mappings and loads the timetable """
+    FNAME_S2I = os.path.join(mappings_dirpath, "station_index.pkl")
+    FNAME_I2S = os.path.join(mappings_dirpath, "index_station.pkl")
+    with open(FNAME_S2I, "rb") as s2i, open(FNAME_I2S, "rb") as i2s:
+        station_idx, index_station = pickle.load(s2i), pickle.load(i2s)
+    # Memory-maps the compiled timetable (compiles stochastic_timetable.pkl if needed)
+    return station_idx, index_station, load_timetable(mappings_dirpath)
+
+
+def files_signature(mappings_dirpath="saved_data"):
+    """
+    Returns a hashable signature (names, modification times and sizes) of the files of the data
+    directory. The compiled timetable is seen through its symlink, the versions being written are not.
+    """
+    signature = []
+    for dirpath, dirnames, filenames in os.walk(mappings_dirpath, followlinks=True):
+        dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.endswith(VERSIONS_SUFFIX))
+        for fname in sorted(filenames):
+            stat = os.stat(os.path.join(dirpath, fname))
+            signature.append((os.path.relpath(os.path.join(dirpath, fname), mappings_dirpath), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def changed_files(version, other_version):
+    """ Paths of the files that differ between two signatures of the data directory """
+    return {fname for fname, _, _ in set(version) ^ set(other_version)}
+
+
+def changes_snapshot(fname):
+    """ Whether a change of 'fname' (relative to the data directory) requires a full reload """
+    fname = fname[:-len(".tmp")] if fname.endswith(".tmp") else fname
+    return fname in SNAPSHOT_FILES or (fname.startswith(TIMETABLE_DIRNAME + os.sep) and fname != CDFS_PATH)
+
+
+def load_planner_data(mappings_dirpath="saved_data"):
+    """ Loads all the data needed by the planner from 'mappings_dirpath' """
+    version = files_signature(mappings_dirpath)
+    station_idx, index_station, stochastic_timetable = depickle_mappings(mappings_dirpath)
+
+    # Fetches the adjacency matrix
+    FNAME_ADJMAT = os.path.join(mappings_dirpath, "adjacency_sparse.npz")
+    adjacency_sparse = sparse.load_npz(FNAME_ADJMAT)
+    footpaths = FootpathIndex.from_adjacency(adjacency_sparse)
+    footpaths.lists()
+
+    # Fetches the list of stations with geo coordinates
+    station_meta_path = os.path.join(mappings_dirpath, "bfkoordgeo.csv")
+    station_meta_df = pd.read_csv(station_meta_path).head(-1)
+    station_coord = pd.Series(list(zip(station_meta_df.Longitude,station_meta_df.Latitude)), index=station_meta_df.Remark).to_dict()
+
+    # Memory-maps the lower bounds of the travel times, if they were built
+    lower_bounds = load_lower_bounds(mappings_dirpath, adjacency_sparse.shape[0])
+
+    return PlannerData(station_idx, index_station, stochastic_timetable, adjacency_sparse, footpaths, station_coord,
+                       station_meta_df, StationSearch(index_station, station_coord), lower_bounds, adjacency_sparse.shape[0], version)
+
+
+def swap_cdfs(data, mappings_dirpath, version):
+    """ Returns a snapshot of 'data' whose timetable uses the CDF matrix currently saved in 'mappings_dirpath' """
+    cdfs = np.load(os.path.join(mappings_dirpath, CDFS_PATH))
+    if cdfs.shape != data.stochastic_timetable.cdfs.shape:
+        raise ValueError("the CDF matrix does not match the timetable (%s instead of %s)" % (cdfs.shape, data.stochastic_timetable.cdfs.shape))
+    return data._replace(stochastic_timetable=data.stochastic_timetable.with_cdfs(cdfs), version=version)
+
+
+def max_rss_mb():
+    """ Peak resident memory of the process, in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class DataStore:
+    """
+    Holds the planner data of one directory, loaded once per process. The data
+    is an immutable snapshot: a reload builds a complete new snapshot before
+    swapping it in, so that running queries keep a consistent view. When only
+    the delay model changed, the new snapshot shares everything but the CDFs
+    with the previous one.
+    """
+
+    def __init__(self, mappings_dirpath="saved_data", check_interval=2.):
+        self.mappings_dirpath = mappings_dirpath
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._last_check = time.monotonic()
+        self.data = self._load()
+
+    def _load(self):
+        start, rss_before = time.perf_counter(), max_rss_mb()
+        data = load_planner_data(self.mappings_dirpath)
+        logger.info("loaded planner data from %s in %.2f s (%d stations, %d connections), peak RSS %.1f MB (+%.1f MB)",
+                    self.mappings_dirpath, time.perf_counter() - start, data.n_stations, len(data.stochastic_timetable),
+                    max_rss_mb(), max_rss_mb() - rss_before)
+        return data
+
+    def reload_if_changed(self):
+        """
+        Reloads the data if the files of the directory changed since the last load.
+        Checks at most once every 'check_interval' seconds, returns True on reload.
+        """
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval or not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_check = now
+            version = files_signature(self.mappings_dirpath)
+            if version == self.data.version:
+                return False
+            if os.path.exists(os.path.join(self.mappings_dirpath, BUILDING_FNAME)):
+                logger.info("%s is being built, keeps serving the previous snapshot", self.mappings_dirpath)
+                return False
+            if not is_complete(os.path.join(self.mappings_dirpath, TIMETABLE_DIRNAME)):
+                logger.info("the timetable of %s is incomplete, keeps serving the previous snapshot", self.mappings_dirpath)
+                return False
+            changed = changed_files(version, self.data.version)
+            try:
+                if not any(changes_snapshot(fname) for fname in changed) and os.path.exists(os.path.join(self.mappings_dirpath, CDFS_PATH)):
+                    self.data = swap_cdfs(self.data, self.mappings_dirpath, version)
+                    logger.info("swapped in the delay model of %s", self.mappings_dirpath)
+                else:
+                    self.data = self._load()
+            except Exception:
+                # files may still be being written, keeps serving the previous snapshot
+                logger.exception("failed to reload planner data from %s", self.mappings_dirpath)
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(mappings_dirpath="saved_data"):
+    """ Returns the DataStore of 'mappings_dirpath', shared by the whole process """
+    key = os.path.abspath(mappings_dirpath)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = DataStore(mappings_dirpath)
+        return _stores[key]
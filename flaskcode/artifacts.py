@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import logging
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+Artifact = namedtuple("Artifact", [
+    "body", # gzip-compressed content
+    "etag",
+    "mimetype",
+])
+
+
+class ArtifactStore:
+    """
+    Rendered pages (the maps of the result and isochrone pages) held in memory
+    under per-request keys, instead of files at fixed paths that concurrent users
+    overwrite. Rendering runs on a pool of worker threads: a page can reference
+    its artifacts as soon as they are submitted, and a request for an artifact
+    waits until it is rendered. Artifacts are stored gzip-compressed, the least
+    recently used ones are dropped beyond 'max_entries' or 'max_bytes'.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 2**20, workers=2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        self._artifacts = OrderedDict()
+        self._pending = {}
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+
+    def submit(self, render, *args, mimetype="text/html"):
+        """ Renders render(*args) (a str) in the background, returns the key of the artifact """
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._pending[key] = self._executor.submit(self._render, key, render, args, mimetype)
+        return key
+
+    def _render(self, key, render, args, mimetype):
+        try:
+            content = render(*args).encode("utf8")
+            artifact = Artifact(gzip.compress(content, compresslevel=6), '"%s"' % hashlib.sha1(content).hexdigest(), mimetype)
+            with self._lock:
+                self._artifacts[key] = artifact
+                self._n_bytes += len(artifact.body)
+                while len(self._artifacts) > self.max_entries or (self._n_bytes > self.max_bytes and len(self._artifacts) > 1):
+                    _, evicted = self._artifacts.popitem(last=False)
+                    self._n_bytes -= len(evicted.body)
+            return artifact
+        except Exception:
+            logger.exception("failed to render artifact %s", key)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def get(self, key, timeout=60):
+        """ Returns the Artifact of 'key', waiting up to 'timeout' seconds if it is being rendered, None if unknown or failed """
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None:
+                self._artifacts.move_to_end(key)
+                return artifact
+            future = self._pending.get(key)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except Exception:
+            return None
@@ -1,17 +1,26 @@
 
-from flask import Flask, request, redirect, url_for, render_template, send_file
+from flask import Flask, request, redirect, url_for, render_template, jsonify, abort, Response, stream_with_context
 
 import sys
 sys.path.append("..")
 import datetime
+import gzip
+import hashlib
+import json
+import time
+from urllib.parse import urlencode
+import logging
 import interface
 import mapmaker
+from artifacts import ArtifactStore
+from cache import QueryCache
+from metrics import Metrics
 
 app = Flask(__name__)
 
 from itertools import groupby
-def route_to_steps(route, fbi):
-    """ Transforms the CSA output to data for the webpage """
+def route_to_steps(route, data):
+    """ Transforms the CSA output to data for the webpage, with the station names of the data snapshot it was planned on """
     steps_grouped = [(k, list(it)) for k, it in groupby(route, lambda s: s["trip_id"])]
     steps = []
     for k, steps_group in steps_grouped:
@@ -21,101 +30,233 @@ def route_to_steps(route, fbi):
         steps.append({
             "trip_ip":steps_group[0]["trip_id"], # maybe not needed
             "type":steps_group[0]["type"],
-            "departure_station_name":fbi.index_station[steps_group[0]["departure_station"]],
-            "arrival_station_name":fbi.index_station[steps_group[0 if walk_or_short else 1]["arrival_station"]],            
+            "departure_station_name":data.index_station[steps_group[0]["departure_station"]],
+            "arrival_station_name":data.index_station[steps_group[0 if walk_or_short else 1]["arrival_station"]],            
             "departure_ts":steps_group[0]["departure_timestamp"].strftime("%H:%M"), # only hours:minutes like gmaps
             "arrival_ts":steps_group[0 if walk_or_short else 1]["arrival_timestamp"].strftime("%H:%M"), # only hours:minutes like gmaps
             "duration":(steps_group[0 if walk_or_short else 1]["arrival_timestamp"] - steps_group[0]["departure_timestamp"]).seconds // 60
         })
     return steps
 
-def isochrones_from_times(times, t_ranges, fbi):
+def request_datetime(default_date=None, default_time=None):
+    """ Parses the date (YYYY-MM-DD) and time (HH:MM) arguments of the request, aborts with a 400 if they are missing or invalid """
+    try:
+        return datetime.datetime.strptime(request.args.get("date", default_date) + " " + request.args.get("time", default_time), "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        abort(400)
+
+def isochrones_from_times(times, t_ranges, data):
     """ Transforms mapping station_name->time to mapping timerange->station_names """
     isochrones = {t_range:[] for t_range in t_ranges}
     for station_name, time in times.items():
         for t_range in t_ranges:
             if time in t_range:
-                isochrones[t_range].append((station_name, time, fbi.latlon(station_name)))
+                isochrones[t_range].append((station_name, time, fbi.latlon(station_name, data)))
     return isochrones
 
 SAVED_DATA_ROOT = "saved_data/"
+# Results precomputed offline by cache.py (its --cache-dir), read but never written by the server so that
+# public queries can not fill the disk. None keeps the query cache in memory only
+QUERY_CACHE_ROOT = None
+ISO_TOLERANCES = [0.5, 0.75, 0.9, 1.0]
+
+# Planner data is loaded once per process and shared by all requests
+fbi = interface.FrontBackInterface(SAVED_DATA_ROOT, cache=QueryCache(disk_dirpath=QUERY_CACHE_ROOT, disk_writes=False), metrics=Metrics())
+# Maps are rendered in the background and kept in memory, per request
+artifacts = ArtifactStore()
+
+@app.before_request
+def reload_data():
+    """ Swaps in the new planner data if the files in SAVED_DATA_ROOT changed """
+    fbi.store.reload_if_changed()
 
 @app.route('/', methods=["GET", "POST"])
 def root():
     """ Flask method of the root page with the forms for route planning or isochrone map making """
-    fbi = interface.FrontBackInterface(SAVED_DATA_ROOT)
     if request.method == "GET":
-        return render_template("dbjp_form.html", all_station_names=list(fbi.station_idx.keys()))
+        service_start, service_end = fbi.stochastic_timetable.service_period()
+        return render_template("dbjp_form.html", service_start=service_start, service_end=service_end)
     elif request.method == "POST":
         #print(request.form.get("btn"))
         if request.form.get("btn") == "Compute route":
             #print(f"posted compute route request from          {request.form.get('from')} to {request.form.get('to')} with qvalue {request.form.get('qvalue')}")
-            stn_from, stn_to, qvalue, date, time = (request.form.get(k) for k in ("from", "to", "qvalue", "date", "time"))
-            return redirect(url_for('result', stn_from=stn_from, stn_to=stn_to, qvalue=qvalue, date=date, time=time))
+            stn_from, stn_to, qvalue, date, time, mode = (request.form.get(k) for k in ("from", "to", "qvalue", "date", "time", "mode"))
+            return redirect(url_for('result', stn_from=stn_from, stn_to=stn_to, qvalue=qvalue, date=date, time=time, mode=mode))
         elif request.form.get("btn") == "Compute isochrones":
             #print(f"posted compute isochrone request originating at {request.form.get('origin')}")
-            stn_origin = request.form.get("origin")
-            return redirect(url_for('iso', stn_origin=stn_origin))
+            stn_origin, date, time = (request.form.get(k) for k in ("origin", "date", "time"))
+            return redirect(url_for('iso', stn_origin=stn_origin, date=date, time=time))
 
 @app.route("/result", methods=["GET"])
 def result():
     """ Flask method of the route planning results page """
     if request.method == "GET":
-        fbi = interface.FrontBackInterface(SAVED_DATA_ROOT)
         #departure_time = datetime.datetime.strptime("02.01.2019 12:00", "%d.%m.%Y %H:%M") placeholder for testing
-        departure_time = datetime.datetime.strptime(request.args.get("date") + " " + request.args.get("time"), "%Y-%m-%d %H:%M")
-        tolerance = int(request.args.get("qvalue"))*.01
+        query_time = request_datetime()
+        tolerance = request.args.get("qvalue", type=int)
+        if tolerance is None or not 0 <= tolerance <= 100:
+            abort(400)
+        tolerance *= .01
+        # One snapshot for the whole request, a reload must not swap the station indices under it
+        data = fbi.data
 
-        # Computes route
-        route = fbi.journey_plan(request.args.get("stn_from"), request.args.get("stn_to"), departure_time, tolerance)
+        # Computes route, leaving at (default) or arriving by the given time
+        if request.args.get("mode") == "arrive":
+            route = fbi.arrive_by(request.args.get("stn_from"), request.args.get("stn_to"), query_time, tolerance, data=data)
+        else:
+            route = fbi.journey_plan(request.args.get("stn_from"), request.args.get("stn_to"), query_time, tolerance, data=data)
 
         # Gets data for webpage from route
-        steps = route_to_steps(route, fbi)
+        steps = route_to_steps(route, data)
+        if not steps:
+            # no journey reaches the destination in the trip window with this q-value
+            return render_template("dbjp_result.html", steps=steps, map_key=None)
 
         # For map drawing, fetch coordinates and names of points
-        coordinates = [fbi.latlon(step["departure_station_name"]) for step in steps]
-        coordinates.append(fbi.latlon(steps[-1]["arrival_station_name"]))
+        coordinates = [fbi.latlon(step["departure_station_name"], data) for step in steps]
+        coordinates.append(fbi.latlon(steps[-1]["arrival_station_name"], data))
         names = [step["departure_station_name"] for step in steps] + [steps[-1]["arrival_station_name"]]
         times = [None,] + [step["departure_ts"] for step in steps]
         walk_bools = [step["type"]=="Walk" for step in steps]
-        # Draws route and saves the resulting file localy
-        mapmaker.map_steps("steps.html", coordinates, names, times, walk_bools)
+        # Draws route in the background, the page's iframe fetches it once rendered
+        map_key = artifacts.submit(mapmaker.steps_html, coordinates, names, times, walk_bools)
 
-        # Returns the HTML file and renders the localy saved file
-        return render_template("dbjp_result.html", steps=steps)
+        # Returns the HTML file
+        return render_template("dbjp_result.html", steps=steps, map_key=map_key)
 
 @app.route("/iso", methods=["GET"])
 def iso():
     """ Flask method of the 4 isochrone maps display page """
     if request.method == "GET":
-        TOLERANCES = [0.5, 0.75, 0.9, 1.0]
-        departure_time = datetime.datetime.strptime("02.01.2019 12:00", "%d.%m.%Y %H:%M")
+        TOLERANCES = ISO_TOLERANCES
+        departure_time = request_datetime("2019-01-02", "12:00")
+        # One snapshot for the whole request, a reload must not swap the station indices under it
+        data = fbi.data
 
-        fbi = interface.FrontBackInterface(SAVED_DATA_ROOT)
-
-        # Computes the times to stations from origin
-        times_to_stations = [
-            fbi.times_to_stations(fbi.station_idx[request.args.get("stn_origin")], departure_time, tolerance)
-            for tolerance in TOLERANCES]
+        # Computes the times to stations from origin, for all tolerances in one scan
+        times_by_tolerance = fbi.times_to_stations_by_tolerance(data.station_idx[request.args.get("stn_origin")], departure_time, TOLERANCES, data=data)
+        times_to_stations = [times_by_tolerance[tolerance] for tolerance in TOLERANCES]
         # Computes isochrone ranges + additional "more than" (k+1)*15 = 150 min or more trips
         T_RANGES = [range(k*15, (k+1)*15) for k in range(9)] + [range(150, 241)]
         # Generates the isochrones from the times to stations using helper method
-        isochrones_arr = [isochrones_from_times(t2s, T_RANGES, fbi) for t2s in times_to_stations]
+        isochrones_arr = [isochrones_from_times(t2s, T_RANGES, data) for t2s in times_to_stations]
 
-        # Draws isochrones in from a reformated array - saves the resulting file localy and renders it
+        # Draws isochrones in the background from a reformated array, the page's iframes fetch them once rendered
         isochrones_fmted_arr = [[
             [station_data for station_data in isochrone] for t_r, isochrone in isochrones.items()] for isochrones in isochrones_arr]
-        for tolerance, isochrones_fmted in zip(TOLERANCES, isochrones_fmted_arr):
-            mapmaker.map_isochrones(f"isochrones{str(tolerance)}.html", isochrones_fmted)
-        return render_template("dbjp_iso.html")
+        mode = request.args.get("mode", "payload")
+        if mode == "payload":
+            # One compact JSON payload for all tolerances, drawn by the shared static base map
+            payload_key = artifacts.submit(mapmaker.isochrones_payload, dict(zip(TOLERANCES, isochrones_fmted_arr)), mimetype="application/json")
+            iso_maps = [(tolerance, url_for('static', filename='iso_map.html') + "?" + urlencode({"key": payload_key, "q": str(tolerance)}))
+                        for tolerance in TOLERANCES]
+        else:
+            # Self-contained folium maps, one GeoJSON layer ("geojson") or one marker per station ("markers")
+            render = mapmaker.isochrones_geojson_html if mode == "geojson" else mapmaker.isochrones_html
+            iso_maps = [(tolerance, url_for('map_endpoint', key=artifacts.submit(render, isochrones_fmted)))
+                        for tolerance, isochrones_fmted in zip(TOLERANCES, isochrones_fmted_arr)]
+        return render_template("dbjp_iso.html", iso_maps=iso_maps)
+
+@app.route("/api/isochrones")
+def isochrones_stream():
+    """
+    Times from stn_origin to all stations as a stream, NDJSON by default or server-sent events
+    (format=sse, or Accept: text/event-stream): a "start" message, then one "stations" message of
+    {station, lat, lon, minutes, probability, tolerance} records per 'step' minutes of departures
+    as the scan settles them, the closest stations first and the unreachable ones last
+    (minutes null), and an "end" message. Invalid dates, times or q values outside (0, 1] give a 400
+    """
+    origin = request.args.get("stn_origin")
+    data = fbi.data # the stream keeps the snapshot of the request, even if the data is reloaded meanwhile
+    if origin not in data.station_idx:
+        abort(404)
+    departure_time = request_datetime("2019-01-02", "12:00")
+    try:
+        tolerances = sorted(set(float(q) for q in request.args.getlist("q"))) or ISO_TOLERANCES
+    except ValueError:
+        abort(400)
+    if not all(0 < q <= 1 for q in tolerances):
+        abort(400)
+    step = max(1, request.args.get("step", 5, type=int))
+    sse = request.args.get("format") == "sse" or "text/event-stream" in request.headers.get("Accept", "")
+
+    def message(body):
+        line = json.dumps(body, separators=(",", ":"), ensure_ascii=False)
+        return "event: %s\ndata: %s\n\n" % (body["type"], line) if sse else line + "\n"
+
+    def generate():
+        start = time.perf_counter()
+        yield message({"type": "start", "origin": origin, "departure": departure_time.isoformat(), "tolerances": tolerances})
+        n_records = 0
+        for batch in fbi.stream_times_to_stations(data.station_idx[origin], departure_time, tolerances, step=step, data=data):
+            records = []
+            for name, minutes, probability, tolerance in batch:
+                lat, lon = fbi.latlon(name, data) if name in data.station_coord else (None, None)
+                records.append({"station": name, "lat": lat, "lon": lon, "minutes": minutes, "probability": round(probability, 4), "tolerance": tolerance})
+            n_records += len(records)
+            yield message({"type": "stations", "records": records})
+        yield message({"type": "end", "records": n_records, "elapsed_ms": round((time.perf_counter() - start) * 1e3, 1)})
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream" if sse else "application/x-ndjson")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # proxies must not buffer the stream
+    return response
+
+@app.route("/cache_stats")
+def cache_stats():
+    """ Hit/miss counters of the query cache """
+    return jsonify(fbi.cache.stats())
+
+@app.route("/metrics")
+def metrics():
+    """ Latency, phase timing and scan counter histograms of the queries, in the Prometheus text format """
+    return Response(fbi.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+MAX_STATION_MATCHES = 50
+
+@app.route("/stations")
+def stations():
+    """ Station search for the autocompletion: the k best matches of q, or the k stations closest to lat/lon """
+    k = max(1, min(request.args.get("k", 10, type=int), MAX_STATION_MATCHES))
+    if "lat" in request.args and "lon" in request.args:
+        lat, lon = request.args.get("lat", type=float), request.args.get("lon", type=float)
+        if lat is None or lon is None:
+            abort(400)
+        body = {"lat": lat, "lon": lon, "stations": fbi.station_search.nearest(lat, lon, k)}
+    else:
+        query = request.args.get("q", "")
+        typos = request.args.get("typos", "1") not in ("0", "false")
+        body = {"query": query, "stations": fbi.station_search.search(query, k, typos)}
+    data = json.dumps(body, ensure_ascii=False).encode()
+    etag = '"%s"' % hashlib.sha1(data).hexdigest()
+    if etag in request.headers.get("If-None-Match", ""):
+        response = Response(status=304)
+    else:
+        response = Response(data, mimetype="application/json")
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "public, max-age=3600"
+    return response
 
 @app.route("/map")
 def map_endpoint():
-    # extremely unsafe for now, i know
-    #print("resending_file")
-    return send_file(request.args.get("fname"), cache_timeout=-1)
+    """ Serves a rendered map from memory, waiting for it to be rendered if needed """
+    artifact = artifacts.get(request.args.get("key", ""))
+    if artifact is None:
+        abort(404)
+    if artifact.etag in request.headers.get("If-None-Match", ""):
+        response = Response(status=304)
+    elif "gzip" in request.headers.get("Accept-Encoding", ""):
+        response = Response(artifact.body, mimetype=artifact.mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(gzip.decompress(artifact.body), mimetype=artifact.mimetype)
+    response.headers["ETag"] = artifact.etag
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "private, max-age=3600" # a key always refers to the same map
+    return response
 
 def start(**kwargs):
+    logging.basicConfig(level=logging.INFO) # only when serving, importing the app must not configure logging
     app.run(host="0.0.0.0", **kwargs)#port=port, debug=debug)
               
 if __name__ == '__main__':
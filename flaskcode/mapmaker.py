@@ -1,3 +1,5 @@
+import json
+
 import folium
 
 def map_route(fpath, route):
@@ -12,7 +14,18 @@ COLORS = ['black', 'darkred', 'red', 'orange', 'yellow', 'green', 'lightblue', '
 # Green shades gradient for our isochrones (imposes max 10 granularity due to fixed size)
 TERRAIN2 = ["#ffffe5", "#f7fcb9", "#d9f0a3", "#addd8e", "#78c679", "#41ab5d", "#238443", "#006837", "#004529", "#000000"]
 
+def to_html(m):
+    """ Renders a map to a standalone HTML page, as folium.Map.save would write it """
+    return m.get_root().render()
+
 def map_isochrones(fpath, isochrones, colors=TERRAIN2):
+    # Serializes the file localy
+    isochrones_map(isochrones, colors).save(fpath)
+
+def isochrones_html(isochrones, colors=TERRAIN2):
+    return to_html(isochrones_map(isochrones, colors))
+
+def isochrones_map(isochrones, colors=TERRAIN2):
     # Centers the map on Hauptbahnhof
     HBF_LOC = (47.3784, 8.5384)
     m = folium.Map(location=HBF_LOC, zoom_start=11)
@@ -24,12 +37,79 @@ def map_isochrones(fpath, isochrones, colors=TERRAIN2):
             m.add_child(
                 folium.CircleMarker(
                     location=station[2], fill='true', radius=6, popup=f"{station[0]}: {displayed_len}", fill_color=colors[i] if station[1] < 240 else "red", color='clear', fill_opacity=1))
+    return m
+
+
+def isochrones_feature_collection(isochrones, colors=TERRAIN2):
+    """ All the stations of the isochrones as one GeoJSON FeatureCollection, with their band (-1 if unreachable) and color """
+    features = []
+    for i, isochrone in enumerate(isochrones):
+        for name, minutes, (lat, lon) in isochrone:
+            reachable = minutes < 240
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [round(lon, 5), round(lat, 5)]},
+                "properties": {
+                    "name": name,
+                    "label": f"{name}: {minutes} min" if reachable else f"{name}: impossible",
+                    "band": i if reachable else -1,
+                    "color": colors[i] if reachable else "red",
+                },
+            })
+    return {"type": "FeatureCollection", "features": features}
 
+def isochrones_geojson_map(isochrones, colors=TERRAIN2):
+    """ Same map as isochrones_map, with all the stations in a single GeoJSON layer instead of one marker each """
+    HBF_LOC = (47.3784, 8.5384)
+    m = folium.Map(location=HBF_LOC, zoom_start=11, prefer_canvas=True)
+    folium.GeoJson(
+        isochrones_feature_collection(isochrones, colors),
+        marker=folium.CircleMarker(radius=6, fill=True, fill_opacity=1, stroke=False),
+        style_function=lambda feature: {"fillColor": feature["properties"]["color"]},
+        popup=folium.GeoJsonPopup(fields=["label"], labels=False),
+    ).add_to(m)
+    return m
+
+def isochrones_geojson_html(isochrones, colors=TERRAIN2):
+    return to_html(isochrones_geojson_map(isochrones, colors))
+
+def isochrones_payload(isochrones_by_tolerance, colors=TERRAIN2):
+    """
+    Compact JSON of the isochrones of several tolerances, drawn by static/iso_map.html:
+    station names and coordinates are listed once, then each tolerance only has the
+    minutes and band (-1 if unreachable) of every station
+    """
+    index, names, coords = {}, [], []
+    layers = {}
+    for tolerance, isochrones in isochrones_by_tolerance.items():
+        minutes, bands = {}, {}
+        for i, isochrone in enumerate(isochrones):
+            for name, station_minutes, (lat, lon) in isochrone:
+                if name not in index:
+                    index[name] = len(names)
+                    names.append(name)
+                    coords.extend((round(lat, 5), round(lon, 5)))
+                minutes[index[name]] = int(station_minutes)
+                bands[index[name]] = i if station_minutes < 240 else -1
+        layers[str(tolerance)] = {
+            "minutes": [minutes.get(j) for j in range(len(names))],
+            "bands": [bands.get(j, -1) for j in range(len(names))],
+        }
+    for layer in layers.values(): # stations first seen in a later tolerance
+        layer["minutes"] += [None] * (len(names) - len(layer["minutes"]))
+        layer["bands"] += [-1] * (len(names) - len(layer["bands"]))
+    payload = {"colors": colors, "unreachable": "red", "names": names, "coords": coords, "layers": layers}
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def map_steps(fpath, coordinates, names, times, walk_bools):
     # Serializes the file localy
-    m.save(fpath)
+    steps_map(coordinates, names, times, walk_bools).save(fpath)
 
+def steps_html(coordinates, names, times, walk_bools):
+    return to_html(steps_map(coordinates, names, times, walk_bools))
 
-def map_steps(fpath, coordinates, names, times, walk_bools):        
+def steps_map(coordinates, names, times, walk_bools):        
     # Load map centred on average coordinates
     avg = [sum(p[i] for p in coordinates)/len(coordinates) for i in (0, 1)]
     m = folium.Map(location=avg, zoom_start=12)
@@ -45,9 +125,7 @@ def map_steps(fpath, coordinates, names, times, walk_bools):
         m.add_child(
             folium.CircleMarker(
                 location=coord, fill='true', radius=4, popup=name + (", arr. " + str(ts) if coord != coordinates[0] else ""), fill_color='white', color='black', fill_opacity=1))
-
-    # Serializes the file localy
-    m.save(fpath)
+    return m
 
 if __name__=="__main__":
     map_route("test_direct.html", None)
@@ -1,39 +1,52 @@
-function autocomplete(inp, arr) {
+function autocomplete(inp, url) {
     /*the autocomplete function takes two arguments,
-    the text field element and an array of possible autocompleted values:*/
+    the text field element and the URL of the station search endpoint:*/
     var currentFocus;
+    var timeout, lastQuery;
     /*execute a function when someone writes in the text field:*/
     inp.addEventListener("input", function(e) {
-        var a, b, i, val = this.value;
+        var val = this.value;
+        /*wait for a short pause in the typing before querying the server:*/
+        clearTimeout(timeout);
+        if (!val) { closeAllLists(); lastQuery = null; return false;}
+        timeout = setTimeout(function() {
+            lastQuery = val;
+            fetch(url + "?" + new URLSearchParams({q: val, k: 10}))
+              .then(function(response) { return response.json(); })
+              .then(function(data) {
+                /*ignore the answers to queries that were typed over since:*/
+                if (data.query === lastQuery) showMatches(data.stations);
+              });
+        }, 150);
+    });
+    function showMatches(matches) {
+        var a, b, i, name, span;
         /*close any already open lists of autocompleted values*/
         closeAllLists();
-        if (!val) { return false;}
         currentFocus = -1;
         /*create a DIV element that will contain the items (values):*/
         a = document.createElement("DIV");
-        a.setAttribute("id", this.id + "autocomplete-list");
+        a.setAttribute("id", inp.id + "autocomplete-list");
         a.setAttribute("class", "autocomplete-items");
         /*append the DIV element as a child of the autocomplete container:*/
-        this.parentNode.appendChild(a);
-        /*for each item in the array...*/
-        for (i = 0; i < arr.length; i++) {
-          /*check if the item starts with the same letters as the text field value:*/
-          /*if (arr[i].substr(0, val.length).toUpperCase() == val.toUpperCase()) {*/
-          if (arr[i].toUpperCase().includes(val.toUpperCase())){
-            /*create a DIV element for each matching element:*/
+        inp.parentNode.appendChild(a);
+        /*for each match...*/
+        for (i = 0; i < matches.length; i++) {
+            name = matches[i].name;
+            span = matches[i].highlight;
+            /*create a DIV element for each match:*/
             b = document.createElement("DIV");
             /*make the matching letters bold:*/
-
-            ss_start = arr[i].toUpperCase().indexOf(val.toUpperCase())
-            b.innerHTML = arr[i].substr(0, ss_start);
-            b.innerHTML += "<strong>" + arr[i].substr(ss_start, val.length) + "</strong>";
-            b.innerHTML += arr[i].substr(ss_start+val.length);
-            /*b.innerHTML = "<strong>" + arr[i].substr(0, val.length) + "</strong>";
-            b.innerHTML += arr[i].substr(val.length);*/
-            /*insert a input field that will hold the current array item's value:*/
-            b.innerHTML += "<input type='hidden' value='" + arr[i] + "'>";
+            b.appendChild(document.createTextNode(name.substring(0, span[0])));
+            b.appendChild(document.createElement("STRONG")).textContent = name.substring(span[0], span[1]);
+            b.appendChild(document.createTextNode(name.substring(span[1])));
+            /*insert a input field that will hold the station name:*/
+            var hidden = document.createElement("INPUT");
+            hidden.type = "hidden";
+            hidden.value = name;
+            b.appendChild(hidden);
             /*execute a function when someone clicks on the item value (DIV element):*/
-                b.addEventListener("click", function(e) {
+            b.addEventListener("click", function(e) {
                 /*insert the value for the autocomplete text field:*/
                 inp.value = this.getElementsByTagName("input")[0].value;
                 /*close the list of autocompleted values,
@@ -41,9 +54,8 @@ function autocomplete(inp, arr) {
                 closeAllLists();
             });
             a.appendChild(b);
-          }
         }
-    });
+    }
     /*execute a function presses a key on the keyboard:*/
     inp.addEventListener("keydown", function(e) {
         var x = document.getElementById(this.id + "autocomplete-list");
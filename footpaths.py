@@ -0,0 +1,119 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6371 # km
+WALKING_SPEED = 1.4 # m/s
+WALKING_RADIUS = 0.5 # km, longer distances are covered by public transport
+TRANSITION_TIME = 2 # transition time at stations in minutes
+
+
+class FootpathIndex:
+    """
+    Footpaths between close stations in compressed sparse row layout: the
+    neighbours of station i and the walking times (in minutes, transition
+    time included) are the contiguous slices indptr[i]:indptr[i+1] of
+    'indices' and 'minutes'.
+    """
+
+    def __init__(self, indptr, indices, minutes):
+        self.indptr = indptr
+        self.indices = indices
+        self.minutes = minutes
+        self.n_stations = len(indptr) - 1
+        self._lists = None
+
+    @classmethod
+    def from_adjacency(cls, adjacency_sparse):
+        """ Builds the index from a sparse adjacency matrix of walking times, as saved in adjacency_sparse.npz """
+        csr = sparse.csr_matrix(adjacency_sparse, copy=True)
+        csr.eliminate_zeros()
+        csr.sort_indices()
+        return cls(csr.indptr.astype(np.int32), csr.indices.astype(np.int32), csr.data.astype(np.float64))
+
+    def get_shape(self):
+        return (self.n_stations, self.n_stations)
+
+    def neighbours(self, station):
+        """ Returns the neighbours of 'station' and the walking times to them, as array slices """
+        start, end = self.indptr[station], self.indptr[station+1]
+        return self.indices[start:end], self.minutes[start:end]
+
+    def walking_time(self, departure_station, arrival_station):
+        """ Walking time between two stations, 0 if they are not neighbours """
+        neighbours, minutes = self.neighbours(departure_station)
+        i = np.searchsorted(neighbours, arrival_station)
+        if i < len(neighbours) and neighbours[i] == arrival_station:
+            return float(minutes[i])
+        return 0.
+
+    def lists(self):
+        """ Per-station lists of (neighbour, walking time) pairs, built once, for scalar loops """
+        if self._lists is None:
+            indptr, indices, minutes = self.indptr.tolist(), self.indices.tolist(), self.minutes.tolist()
+            self._lists = [list(zip(indices[indptr[i]:indptr[i+1]], minutes[indptr[i]:indptr[i+1]])) for i in range(self.n_stations)]
+        return self._lists
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """ Great-circle distances (in km) between arrays of points given in degrees """
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2-lon1)/2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def walking_time(distance, walking_speed=WALKING_SPEED):
+    """ Minutes needed to walk 'distance' km """
+    return (distance*1000) / walking_speed / 60
+
+
+def build_footpaths(station_coord, index_station, radius=WALKING_RADIUS, transition_time=TRANSITION_TIME, walking_speed=WALKING_SPEED):
+    """
+    Builds the sparse adjacency matrix of walking times between stations that
+    are less than 'radius' km apart, plus self-loops of 'transition_time'. Close
+    pairs are found with a KD-tree on the unit sphere instead of comparing all
+    pairs, so that the build time grows with the number of footpaths.
+    """
+    N = len(index_station)
+    lon, lat = np.array([station_coord[index_station[i]] for i in range(N)], dtype=np.float64).T
+    phi, lam = np.radians(lat), np.radians(lon)
+    points = np.column_stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)))
+    # chord length on the unit sphere corresponding to 'radius' km
+    chord = 2 * np.sin(radius / (2 * EARTH_RADIUS))
+    pairs = cKDTree(points).query_pairs(chord, output_type="ndarray")
+    rows, cols = pairs[:, 0], pairs[:, 1]
+    distances = haversine(lon[rows], lat[rows], lon[cols], lat[cols])
+    close = distances < radius
+    rows, cols = rows[close], cols[close]
+    data = walking_time(distances[close], walking_speed) + transition_time
+
+    data1 = np.concatenate((data, data, np.full(N, transition_time, dtype=np.float64))) # add self-loops
+    rows1 = np.concatenate((rows, cols, np.arange(N)))
+    cols1 = np.concatenate((cols, rows, np.arange(N)))
+    return sparse.coo_matrix((data1, (rows1, cols1)), shape=(N, N)).tocsr()
+
+
+def build_from_dir(mappings_dirpath="saved_data", **kwargs):
+    """ Builds the footpaths of the stations of 'mappings_dirpath', from its bfkoordgeo.csv """
+    with open(os.path.join(mappings_dirpath, "index_station.pkl"), "rb") as i2s:
+        index_station = pickle.load(i2s)
+    station_meta_df = pd.read_csv(os.path.join(mappings_dirpath, "bfkoordgeo.csv")).head(-1)
+    station_coord = pd.Series(list(zip(station_meta_df.Longitude,station_meta_df.Latitude)), index=station_meta_df.Remark).to_dict()
+    return build_footpaths(station_coord, index_station, **kwargs)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Builds adjacency_sparse.npz, the walking times between close stations")
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    parser.add_argument("--radius", type=float, default=WALKING_RADIUS, help="maximal walking distance in km")
+    parser.add_argument("--transition-time", type=float, default=TRANSITION_TIME, help="transition time at stations in minutes")
+    parser.add_argument("--walking-speed", type=float, default=WALKING_SPEED, help="walking speed in m/s")
+    args = parser.parse_args()
+    adjacency_sparse = build_from_dir(args.mappings_dirpath, radius=args.radius, transition_time=args.transition_time, walking_speed=args.walking_speed)
+    sparse.save_npz(os.path.join(args.mappings_dirpath, "adjacency_sparse.npz"), adjacency_sparse)
+    print("saved", adjacency_sparse.nnz, "footpaths between", adjacency_sparse.shape[0], "stations")
@@ -1,5 +1,54 @@
+import logging
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from datetime import timedelta
 
+import numpy as np
+
+from footpaths import FootpathIndex
+from metrics import phase_timer
+from timetable import ColumnarTimetable
+
+logger = logging.getLogger(__name__)
+
+ProfileJourney = namedtuple("ProfileJourney", [
+    "departure_timestamp", # leaving the departure station
+    "arrival_timestamp", # at the arrival station
+    "probability", # route probability
+    "station", # where the first connection is boarded
+    "entry", # idx of the journey in the StochasticProfile of 'station'
+])
+
+
+class OneToAllResult:
+    """
+    Result of a computation from one departure station to all stations, for one
+    tolerance: earliest arrival (in minutes since the epoch of the timetable, nan
+    if unreachable) and route probability (0 if unreachable) of every station.
+    Routes are only reconstructed for the stations that are asked about.
+    """
+
+    def __init__(self, csa, tolerance, arrival_minutes, probabilities):
+        self.csa = csa
+        self.tolerance = tolerance
+        self.arrival_minutes = arrival_minutes
+        self.probabilities = probabilities
+
+    @property
+    def reachable(self):
+        return ~np.isnan(self.arrival_minutes)
+
+    def travel_minutes(self):
+        """ Whole minutes from the departure time to the arrival at every station, nan if unreachable """
+        tt = self.csa.stochastic_timetable
+        departure_minute = (self.csa.departure_time - tt.epoch).total_seconds() / 60
+        return np.floor(self.arrival_minutes - departure_minute)
+
+    def route(self, arrival_station):
+        """ Reconstructs the route to 'arrival_station' """
+        return self.csa.get_route(self.csa.departure_station, arrival_station, self.csa.departure_time, tolerance=self.tolerance)
+
+
 class StochasticCSA:
     """
     An abstraction of the Connection Scan Algorithm
@@ -10,115 +59,266 @@ class StochasticCSA:
         A data structure to store the entries at a given station, 
         correponding to different paths, with increasing arrival 
         time and route probability.
+        
+        The Pareto set of entries is stored in parallel lists sorted by arrival
+        timestamp (so that entries are found by bisection), and pruned in place.
+        Every entry also gets a label, an idx in append-only lists that are never
+        reordered, which is what other tables and trips point to.
         """
-    
-        CONNECTION_IDX = 0 # idx in the stochastic timetable
-        ARRIVAL_TS = 1 # Arrival timestamp at station X
-        IN_ROUTE = 2 # idx in the preceding StochasticTable
-        ROUTE_PROB = 3 # Arrival probability of the route that ends at X
+
+        __slots__ = ("max_ts", "arrivals", "probs", "cdfs", "labels",
+                     "l_connection", "l_in_route", "l_arrival", "l_prob")
 
         def __init__(self, max_ts): 
-            self.entries = [(-1,max_ts,-1,0)]
+            self.max_ts = max_ts
+            # Pareto set, sorted by increasing arrival timestamp and route probability
+            self.arrivals = [] # Arrival timestamp at station X
+            self.probs = [] # Arrival probability of the route that ends at X
+            self.cdfs = [] # CDF of the incoming connection (None for walks from the departure station)
+            self.labels = [] # idx of the entry in the label lists
+            # Labels, idx never change once created
+            self.l_connection = [] # idx in the stochastic timetable
+            self.l_in_route = [] # label in the preceding StochasticTable
+            self.l_arrival = []
+            self.l_prob = []
+            
+        def __len__(self):
+            return len(self.arrivals)
             
-        def get_indices(self, i):
-            e = self.entries[i]
-            return e[self.CONNECTION_IDX], e[self.IN_ROUTE]
+        def get_indices(self, label):
+            return self.l_connection[label], self.l_in_route[label]
         
-        def get_probability(self, i):
-            e = self.entries[i]
-            return e[self.ROUTE_PROB]
+        def get_probability(self, label):
+            return self.l_prob[label]
+            
+        def get_arrival(self, label):
+            return self.l_arrival[label]
+            
+        def first_entry(self, tolerance=0):
+            """ Position of the earliest entry whose route probability is at least 'tolerance' """
+            return bisect_left(self.probs, tolerance) if tolerance else 0
+            
+        def earliest_arrival(self, tolerance=0):
+            i = self.first_entry(tolerance)
+            return self.arrivals[i] if i < len(self.arrivals) else self.max_ts
             
-        def earliest_arrival(self):
-            return self.entries[0][self.ARRIVAL_TS]
+        def earliest_label(self, tolerance=0):
+            i = self.first_entry(tolerance)
+            return self.labels[i] if i < len(self.labels) else -1
 
-        def update_table(self, connection_idx, arrival_ts, in_route, route_prob):
+        def update_table(self, connection_idx, arrival_ts, in_route, route_prob, cdf=None):
             """
             Adds an entry to the table, meaning a new connection that was appended to 
             a certain route, with an updated route probability. Both arrival timestamps
-            and route probabilites are (must be) stored in increasing order.
+            and route probabilites are stored in increasing order, the new entry removes
+            the ones it dominates. Entries arriving at or after max_ts are dropped.
             """
-            new_entry = (connection_idx, arrival_ts, in_route, route_prob)
-            if arrival_ts > self.entries[-1][self.ARRIVAL_TS]:
-                if route_prob > self.entries [-1][self.ROUTE_PROB]:
-                    self.entries.append(new_entry)
-            else:
-                i = 0
-                prev_prob = 0
-                while arrival_ts > self.entries[i][self.ARRIVAL_TS]:
-                    prev_prob = self.entries[i][self.ROUTE_PROB]
-                    i += 1
-                if route_prob > prev_prob:
-                    next_ts = self.entries[i][self.ARRIVAL_TS]
-                    next_prob = self.entries[i][self.ROUTE_PROB]
-                    if route_prob >= next_prob: 
-                        j = i
-                        while j < len(self.entries) and route_prob >= self.entries[j][self.ROUTE_PROB]:
-                            j += 1
-                        self.entries = self.entries[:i] + [new_entry] + self.entries[j:]
-                    elif arrival_ts != next_ts:
-                        self.entries = self.entries[:i] + [new_entry] + self.entries[i:]
-
-        def best_connecting(self, stochastic_timetable, departure_timestamp):
+            if arrival_ts >= self.max_ts:
+                return
+            arrivals, probs = self.arrivals, self.probs
+            i = bisect_left(arrivals, arrival_ts)
+            if route_prob <= (probs[i-1] if i else 0):
+                return
+            # first entry (from i on) with a higher probability than the new one
+            j = bisect_right(probs, route_prob, i)
+            if j == i and i < len(arrivals) and arrivals[i] == arrival_ts:
+                return
+            label = len(self.l_connection)
+            self.l_connection.append(connection_idx)
+            self.l_in_route.append(in_route)
+            self.l_arrival.append(arrival_ts)
+            self.l_prob.append(route_prob)
+            arrivals[i:j] = (arrival_ts,)
+            probs[i:j] = (route_prob,)
+            self.cdfs[i:j] = (cdf,)
+            self.labels[i:j] = (label,)
+
+        def best_connecting(self, departure_timestamp):
             """
             Given a new connection departing at 'departure_timestamp', finds the best 
             route that arrives at station X. Makes use of the CDF of the incoming 
             connection at X (last connection of the route), to compute the updated 
-            route probability.  
+            route probability. Walks from the departure station are not subject to 
+            delays.
+            
+            Entries that arrived at least 10 minutes earlier are certain to connect, so 
+            the best of them is the latest one; only the (at most 10) entries arriving 
+            in the last 10 minutes need their CDF to be evaluated.
             """
-            max_e_idx = -1
-            max_prb = 0
-            for e_idx, e in enumerate(self.entries):
-                arrival_timestamp = e[self.ARRIVAL_TS]
-                if arrival_timestamp <= departure_timestamp:
-                    c_idx = e[self.CONNECTION_IDX]
-                    route_prb = e[self.ROUTE_PROB]
-                    difference = (departure_timestamp-arrival_timestamp).seconds // 60
-                    prev_cdf = stochastic_timetable[c_idx]["cdf"]
-                    extended_route_prb = route_prb * (1 if difference >= 10 else prev_cdf[difference])
-                    if extended_route_prb > max_prb:
-                        max_e_idx = e_idx
-                        max_prb = extended_route_prb
-            return max_e_idx, max_prb    
+            arrivals = self.arrivals
+            end = bisect_right(arrivals, departure_timestamp)
+            safe = bisect_right(arrivals, departure_timestamp - 10, 0, end)
+            if safe:
+                max_i, max_prb = safe - 1, self.probs[safe - 1]
+            else:
+                max_i, max_prb = -1, 0
+            for i in range(safe, end):
+                cdf = self.cdfs[i]
+                extended_route_prb = self.probs[i] * (cdf[int(departure_timestamp - arrivals[i])] if cdf else 1)
+                if extended_route_prb > max_prb:
+                    max_i, max_prb = i, extended_route_prb
+            return (self.labels[max_i] if max_i >= 0 else -1), max_prb
             
     
-    def __init__(self, stochastic_timetable, walking_times):
+    class StochasticProfile:
+        """
+        The journeys from a given station to the target of a profile computation,
+        as (departure, arrival, probability) entries. Connections are scanned by
+        decreasing departure time, so entries are appended by decreasing departure
+        and an entry is only kept if no entry departing later arrives earlier with
+        a higher probability.
+        
+        The (arrival, probability) Pareto set of the entries up to the last one of
+        every departure timestamp is kept, so that the best journeys catchable by a
+        transfer that is certain to succeed are found by a single bisection: a transfer
+        always connects to all the entries of a departure timestamp or to none. The
+        sets refer to the (arrival, probability, entry) tuples created once per entry.
+        """
+
+        __slots__ = ("neg_departures", "departures", "arrivals", "probs",
+                     "boardings", "exits", "nexts", "groups", "frontiers",
+                     "f_arrivals", "f_probs", "f_options")
+
+        def __init__(self):
+            # Entries, sorted by decreasing departure timestamp
+            self.neg_departures = [] # -departure, increasing, for bisection
+            self.departures = []
+            self.arrivals = [] # Arrival timestamp at the target
+            self.probs = [] # Route probability
+            self.boardings = [] # idx of the connection boarded at the station
+            self.exits = [] # idx of the connection of the same trip that is left
+            self.nexts = [] # (station, entry) the route continues with, None if it ends at the target
+            self.groups = [] # index in frontiers of the set of the entry's departure timestamp
+            self.frontiers = [] # Pareto set of the entries up to every departure timestamp but the last
+            # Current Pareto set, sorted by increasing arrival timestamp and route probability
+            self.f_arrivals = []
+            self.f_probs = []
+            self.f_options = [] # (arrival, probability, entry)
+
+        def __len__(self):
+            return len(self.departures)
+
+        def add_entry(self, departure_ts, arrival_ts, route_prob, boarding, exit, next_entry):
+            """
+            Adds a journey departing at 'departure_ts', which must not be later than the
+            departure of the existing entries. Returns False if it is dominated.
+            """
+            f_arrivals, f_probs = self.f_arrivals, self.f_probs
+            i = bisect_right(f_arrivals, arrival_ts)
+            if route_prob <= (f_probs[i-1] if i else 0):
+                return False
+            if self.departures and departure_ts != self.departures[-1]:
+                # the entries of the previous departure timestamp are all there
+                self.frontiers.append(tuple(self.f_options))
+            entry = len(self.departures)
+            self.neg_departures.append(-departure_ts)
+            self.departures.append(departure_ts)
+            self.arrivals.append(arrival_ts)
+            self.probs.append(route_prob)
+            self.boardings.append(boarding)
+            self.exits.append(exit)
+            self.nexts.append(next_entry)
+            self.groups.append(len(self.frontiers))
+            # the new entry removes the ones it dominates from the Pareto set
+            i = bisect_left(f_arrivals, arrival_ts)
+            j = bisect_right(f_probs, route_prob, i)
+            f_arrivals[i:j] = (arrival_ts,)
+            f_probs[i:j] = (route_prob,)
+            self.f_options[i:j] = ((arrival_ts, route_prob, entry),)
+            return True
+
+        def connecting(self, ready_ts, cdf, station, exit, options):
+            """
+            Appends to 'options' the journeys that can be taken when reaching 'station'
+            (the one of this profile) at 'ready_ts' by leaving connection 'exit', whose
+            delays follow 'cdf', as (arrival, probability, exit, (station, entry)).
+            Entries departing at least 10 minutes later are certain to connect, so
+            their Pareto set is the one of the last of them; only the entries
+            departing within 10 minutes need the CDF to be evaluated.
+            """
+            neg_departures = self.neg_departures
+            end = bisect_right(neg_departures, -ready_ts)
+            safe = bisect_right(neg_departures, -(ready_ts + 10), 0, end)
+            if not safe:
+                frontier = ()
+            elif safe == len(neg_departures):
+                frontier = self.f_options
+            else:
+                frontier = self.frontiers[self.groups[safe - 1]]
+            for arrival_ts, route_prob, entry in frontier:
+                options.append((arrival_ts, route_prob, exit, (station, entry)))
+            for e in range(safe, end):
+                options.append((self.arrivals[e], self.probs[e] * cdf[int(self.departures[e] - ready_ts)], exit, (station, e)))
+
+    def __init__(self, stochastic_timetable, walking_times, lower_bounds=None):
+        if not isinstance(stochastic_timetable, ColumnarTimetable):
+            # legacy list of connection dicts
+            stochastic_timetable = ColumnarTimetable.from_connections(stochastic_timetable)
         self.stochastic_timetable = stochastic_timetable
+        if not isinstance(walking_times, FootpathIndex):
+            # sparse adjacency matrix of walking times
+            walking_times = FootpathIndex.from_adjacency(walking_times)
         self.walking_times = walking_times
-        self.n_stations = walking_times.get_shape()[0]
+        self.n_stations = walking_times.n_stations
+        # lower_bounds[t][s]: minutes needed at least to go from station s to station t (see lower_bounds.py)
+        self.lower_bounds = lower_bounds
+        self.stats = None
         
     def check_neighborhood(self, arrival_station, arrival_timestamp):
         """
         Checks the neighborhood of a certain station (reachable stations), and updates 
-        the StochasticTables accordingly.
-        """
-        rows, cols = self.walking_times.nonzero() 
-        neighborhood = (rows == arrival_station)
-        outs = []
-        for station in cols[neighborhood]:
-            walking_time = self.walking_times[arrival_station,station]
-            walk_timestamp = arrival_timestamp + timedelta(minutes=walking_time)
+        the StochasticTables accordingly. Timestamps are in minutes since the epoch of 
+        the timetable.
+        """
+        for station, walking_time in self.walking_times.lists()[arrival_station]:
+            yield station, arrival_timestamp + walking_time
+
+    def counting_neighborhood(self, arrival_station, arrival_timestamp):
+        """ check_neighborhood that counts the footpaths it relaxes in self.stats """
+        counters = self.stats.start_counting()
+        for station, walk_timestamp in self.check_neighborhood(arrival_station, arrival_timestamp):
+            counters["footpath_relaxations"] += 1
             yield station, walk_timestamp
                 
-    def main_loop(self, arrival_station):
+    def main_loop(self, arrival_station, lo=None, hi=None):
         """
-        Main component of the CSA
+        Main component of the CSA, only scans the connections departing between the
+        departure time and the end of the trip window, or the connections [lo, hi) of
+        the timetable, so that a scan can be run by slices. With several tolerances, the
+        scan runs at the lowest one and stops once the target is reached at the
+        highest one. The counters of the scan are plain locals, only incremented in
+        the branches that update tables, and are reported to self.stats if any
+        (footpaths are only counted then, by counting_neighborhood).
+        
+        With lower bounds and a target, a connection is skipped if even the fastest
+        way from its arrival station to the target arrives after the earliest arrival
+        found so far: every route it starts (staying on board included) arrives later,
+        so the tables of the target are the same as without pruning.
         """
         earliest = self.max_ts
+        target_tolerance = self.tolerances[-1]
+        tt = self.stochastic_timetable
+        cdf_rows = tt.cdf_rows()
+        if lo is None:
+            lo, hi = tt.scan_range(self.departure_ts, self.max_ts)
+        end, n_reachable, n_feasible, n_pruned = hi, 0, 0, 0
+        to_target = None if self.lower_bounds is None or arrival_station is None else self.lower_bounds[arrival_station].tolist()
+        neighborhood = self.check_neighborhood if self.stats is None else self.counting_neighborhood
+        columns = zip(tt.trip[lo:hi].tolist(), tt.departure_station[lo:hi].tolist(), tt.arrival_station[lo:hi].tolist(),
+                      tt.departure_minute[lo:hi].tolist(), tt.arrival_minute[lo:hi].tolist(), tt.cdf[lo:hi].tolist())
         
-        for i, c in enumerate(self.stochastic_timetable):
-            
-            c_trip_id = c["trip_id"]
-            c_departure_station = c["departure_station"]
-            c_arrival_station = c["arrival_station"]
-            c_departure_ts = c["departure_timestamp"]
-            c_arrival_ts = c["arrival_timestamp"]
+        for i, (c_trip_id, c_departure_station, c_arrival_station, c_departure_ts, c_arrival_ts, c_cdf) in enumerate(columns, lo):
             
             if c_departure_ts > earliest:
-                return
+                end = i
+                break
+            elif to_target is not None and c_arrival_ts + to_target[c_arrival_station] > earliest:
+                n_pruned += 1
             elif c_departure_ts >= self.stochastic_tables[c_departure_station].earliest_arrival() \
                 or c_trip_id in self.stochastic_trips:
+                n_reachable += 1
                 
-                e_idx, route_prb  = self.stochastic_tables[c_departure_station].best_connecting(self.stochastic_timetable, c_departure_ts)
+                e_idx, route_prb  = self.stochastic_tables[c_departure_station].best_connecting(c_departure_ts)
                 c_idx = i
                 
                 if c_trip_id in self.stochastic_trips:
@@ -133,10 +333,19 @@ class StochasticCSA:
                     self.stochastic_trips[c_trip_id] = [(c_idx,e_idx,route_prb)]
                    
                 if route_prb >= self.tolerance:
-                    for station, walk_timestamp in self.check_neighborhood(c_arrival_station, c_arrival_ts):
-                        self.stochastic_tables[station].update_table(c_idx,walk_timestamp,e_idx,route_prb)
+                    n_feasible += 1
+                    cdf = cdf_rows[c_cdf]
+                    for station, walk_timestamp in neighborhood(c_arrival_station, c_arrival_ts):
+                        self.stochastic_tables[station].update_table(c_idx,walk_timestamp,e_idx,route_prb,cdf)
                         if station == arrival_station:
-                            earliest = self.stochastic_tables[station].earliest_arrival()
+                            earliest = self.stochastic_tables[station].earliest_arrival(target_tolerance)
+
+        if self.stats is not None:
+            counters = self.stats.start_counting()
+            counters["connections_scanned"] += end - lo
+            counters["connections_reachable"] += n_reachable
+            counters["connections_feasible"] += n_feasible
+            counters["connections_pruned"] += n_pruned
         
     def generate_walk(self, departure_station, arrival_station, departure_timestamp):
         """
@@ -146,27 +355,34 @@ class StochasticCSA:
         walk_connection['departure_station'] = departure_station
         walk_connection['arrival_station'] = arrival_station
         walk_connection['departure_timestamp'] = departure_timestamp
-        walking_time = self.walking_times[departure_station,arrival_station]
+        walking_time = self.walking_times.walking_time(departure_station,arrival_station)
         arrival_timestamp = departure_timestamp + timedelta(minutes=walking_time)
         walk_connection['arrival_timestamp'] = arrival_timestamp
         
         return walk_connection
         
-    def get_route(self, departure_station, arrival_station, departure_time):
+    def get_route(self, departure_station, arrival_station, departure_time, *, tolerance=None, stats=None):
         """
         Reconstruct the route from 'departure_station' to 'arrival_station', starting 
-        at 'departure_time'
+        at 'departure_time', for one of the tolerances of the last computation (the 
+        lowest by default)
         """
+        with phase_timer(stats, "get_route"):
+            return self._get_route(departure_station, arrival_station, departure_time, tolerance)
+
+    def _get_route(self, departure_station, arrival_station, departure_time, tolerance):
         route = []
+        tolerance = self.tolerance if tolerance is None else tolerance
         
-        if self.stochastic_tables[arrival_station].earliest_arrival() == self.max_ts:
-            print("NO SOLUTION")
+        if self.stochastic_tables[arrival_station].earliest_arrival(tolerance) == self.max_ts:
+            logger.debug("NO SOLUTION")
         else:
-            c_idx, e_idx = self.stochastic_tables[arrival_station].get_indices(0)
-            route_prb = self.stochastic_tables[arrival_station].get_probability(0)
+            label = self.stochastic_tables[arrival_station].earliest_label(tolerance)
+            c_idx, e_idx = self.stochastic_tables[arrival_station].get_indices(label)
+            route_prb = self.stochastic_tables[arrival_station].get_probability(label)
             next_station = arrival_station
             next_trip = ""
-            print("Route probability:",route_prb)
+            logger.debug("Route probability: %s", route_prb)
             
             c_departure_station = None
             while c_idx != -1:
@@ -186,7 +402,7 @@ class StochasticCSA:
                 
                 if e_idx < 0:
                     trip_initial = -e_idx - 1
-                    c_idx, e_idx, _ = self.stochastic_trips[c_trip_id][trip_initial]
+                    c_idx, e_idx, _ = self.stochastic_trips[self.stochastic_timetable.trip[c_idx]][trip_initial]
                 else:
                     c_idx, e_idx = self.stochastic_tables[c_departure_station].get_indices(e_idx)            
                         
@@ -195,18 +411,287 @@ class StochasticCSA:
         
         return route[::-1]             
         
-    def compute(self, departure_station, departure_time, tolerance, max_delta, *, arrival_station=None):
+    def one_to_all(self, tolerance=None, *, stats=None):
         """
-        Run the CSA from 'departure_station', at 'departure_time'
+        Reads the earliest arrival and route probability of every station from the 
+        tables of the last computation, for one of its tolerances (the lowest by 
+        default). Arrivals are the ones a route ends with: the arrival of the last 
+        connection if it stops at the station, the end of the walk otherwise.
         """
-        self.max_ts = departure_time + timedelta(hours=max_delta)
-        self.tolerance = tolerance
-        self.stochastic_tables = [StochasticCSA.StochasticTable(self.max_ts) for _ in range(self.n_stations)]
+        with phase_timer(stats, "one_to_all"):
+            return self._one_to_all(tolerance)
+
+    def _one_to_all(self, tolerance):
+        tolerance = self.tolerance if tolerance is None else tolerance
+        arrival_minutes = np.full(self.n_stations, np.nan)
+        probabilities = np.zeros(self.n_stations)
+        connections = np.full(self.n_stations, -1, dtype=np.int64)
+        for station, table in enumerate(self.stochastic_tables):
+            label = table.earliest_label(tolerance)
+            if label >= 0:
+                arrival_minutes[station] = table.get_arrival(label)
+                probabilities[station] = table.get_probability(label)
+                connections[station] = table.get_indices(label)[0]
+        tt = self.stochastic_timetable
+        stations = np.flatnonzero(connections >= 0)
+        direct = stations[tt.arrival_station[connections[stations]] == stations]
+        arrival_minutes[direct] = tt.arrival_minute[connections[direct]]
+        return OneToAllResult(self, tolerance, arrival_minutes, probabilities)
         
-        for station, walk_timestamp in self.check_neighborhood(departure_station, departure_time):
-            self.stochastic_tables[station].update_table(-1,walk_timestamp,-1,1)
+    def compute(self, departure_station, departure_time, tolerance, max_delta, *, arrival_station=None, stats=None):
+        """
+        Run the CSA from 'departure_station', at 'departure_time'. 'tolerance' may be
+        a sequence of tolerances, which are all answered by the same scan: an entry
+        is kept for a tolerance iff its route probability reaches it, so the tables
+        computed at the lowest tolerance contain the ones of all the higher ones.
+        'stats' (a metrics.QueryStats) receives the counters and timings of the
+        phases of the computation.
+        """
+        self.stats = stats
+        with phase_timer(stats, "compute"):
+            self._compute(departure_station, departure_time, tolerance, max_delta, arrival_station)
+        self.count_tables(stats)
+
+    def count_tables(self, stats):
+        """ Adds the sizes of the tables and the number of trips of the last computation to the counters of 'stats' """
+        if stats is not None:
+            counters = stats.start_counting()
+            counters["table_inserts"] += sum(len(table.l_connection) for table in self.stochastic_tables)
+            counters["table_entries"] += sum(len(table) for table in self.stochastic_tables)
+            counters["max_table_entries"] = max(counters["max_table_entries"], max(map(len, self.stochastic_tables), default=0))
+            counters["trips"] += len(self.stochastic_trips)
+
+    def _compute(self, departure_station, departure_time, tolerance, max_delta, arrival_station):
+        self.start_scan(departure_station, departure_time, tolerance, max_delta)
+        with phase_timer(self.stats, "main_loop"):
+            self.main_loop(arrival_station)
+
+    def start_scan(self, departure_station, departure_time, tolerance, max_delta):
+        """ Sets up the tables of a computation, with the walks from the departure station """
+        self.departure_station = departure_station
+        self.departure_time = departure_time
+        self.departure_ts = self.stochastic_timetable.minute(departure_time)
+        self.max_ts = self.departure_ts + int(max_delta * 60)
+        self.tolerances = sorted(set(tolerance)) if hasattr(tolerance, "__iter__") else [tolerance]
+        self.tolerance = self.tolerances[0]
+        self.stochastic_tables = [self.StochasticTable(self.max_ts) for _ in range(self.n_stations)]
+        
+        with phase_timer(self.stats, "check_neighborhood"):
+            for station, walk_timestamp in self.check_neighborhood(departure_station, self.departure_ts):
+                self.stochastic_tables[station].update_table(-1,walk_timestamp,-1,1)
             
         self.stochastic_trips = {}
+
+    def settle(self, departure_station, departure_time, tolerance, max_delta, *, step=5, stats=None):
+        """
+        One-to-all compute that yields the stations as soon as their earliest arrival is
+        final. The connections are scanned by slices of 'step' minutes of departure, and
+        the connections of the next slices depart (so arrive) at or after the end of the
+        slice: a station whose earliest arrival at a tolerance is before it will not get
+        an earlier one, nor lose that entry. Yields, per slice, the list of the stations
+        settled by it as (station, whole minutes of travel, route probability, tolerance),
+        the departure station first; the stations still unreachable at the end of the
+        trip window come last, with nan minutes and a probability of 0. The minutes are
+        the ones of one_to_all.
+        """
+        self.stats = stats
+        with phase_timer(stats, "compute"):
+            self.start_scan(departure_station, departure_time, tolerance, max_delta)
+        tt = self.stochastic_timetable
+        departure_minute = (departure_time - tt.epoch).total_seconds() / 60
+        # stations without any entry yet, the others are checked at every tolerance they are not settled at
+        unreached = set(range(self.n_stations)) - {departure_station}
+        unsettled = {t: [] for t in self.tolerances}
+        yield [(departure_station, 0, 1., t) for t in self.tolerances]
+
+        tables = self.stochastic_tables
+        lo, hi = tt.scan_range(self.departure_ts, self.max_ts)
+        # the last slice ends with the scan, which includes the connections departing at max_ts
+        slice_ends = np.append(np.arange(self.departure_ts + step, self.max_ts + 1, step), self.max_ts + 1)
+        slice_his = (lo + np.searchsorted(np.asarray(tt.departure_minute[lo:hi]), slice_ends, side="left")).tolist()
+        for slice_end, mid in zip(slice_ends.tolist(), slice_his):
+            with phase_timer(stats, "compute"), phase_timer(stats, "main_loop"):
+                self.main_loop(None, lo, mid)
+            lo = mid
+            # the next connections depart at or after slice_end, so they arrive at or after it
+            settled_before = slice_end if mid < hi else float("inf")
+            reached = {station for station in unreached if tables[station].arrivals}
+            unreached -= reached
+            settled = []
+            for t in self.tolerances:
+                unsettled[t].extend(reached)
+                pending = []
+                for station in unsettled[t]:
+                    table = tables[station]
+                    # the earliest entry at any probability is the cheapest to read, and arrives first
+                    label = table.earliest_label(t) if table.arrivals[0] < settled_before else -1
+                    if label < 0 or table.get_arrival(label) >= settled_before:
+                        pending.append(station)
+                        continue
+                    arrival = table.get_arrival(label)
+                    connection = table.get_indices(label)[0]
+                    if connection >= 0 and tt.arrival_station[connection] == station:
+                        arrival = tt.arrival_minute[connection]
+                    settled.append((station, int(np.floor(arrival - departure_minute)), table.get_probability(label), t))
+                unsettled[t] = pending
+            if settled:
+                yield settled
+        self.count_tables(stats)
+        yield [(station, np.nan, 0., t) for t in self.tolerances for station in sorted(unsettled[t] + list(unreached))]
         
-        self.main_loop(arrival_station)
-        
\ No newline at end of file
+
+    @staticmethod
+    def pareto_options(options):
+        """ Keeps the (arrival, probability, ...) options that no other option dominates, by increasing arrival """
+        options.sort(key=lambda option: (option[0], -option[1]))
+        pareto, best_prob = [], 0
+        for option in options:
+            if option[1] > best_prob:
+                pareto.append(option)
+                best_prob = option[1]
+        return pareto
+
+    def compute_profile(self, arrival_station, window_start, window_end, max_delta, *, departure_station=None, tolerance=0):
+        """
+        Profile variant of the CSA: computes, by scanning once the connections in
+        decreasing departure time, the Pareto sets of (departure, arrival, probability)
+        of the journeys from every station to 'arrival_station' that depart between
+        'window_start' and 'window_end' and arrive at most 'max_delta' hours after
+        'window_end'. Only journeys using at least one connection are considered, and
+        only the ones with a probability of at least 'tolerance': transfers before a
+        journey can only lower its probability, so the others are dropped as soon as
+        they are found. The connections that can not reach the target in time according
+        to the lower bounds are skipped. With 'departure_station', so are the ones that
+        can not be reached from it in time, and the scan stops once the journey from it
+        leaving the latest while arriving by 'window_end' is found (the one of
+        latest_departure): the profiles of the other stations are then incomplete.
+        """
+        tt = self.stochastic_timetable
+        self.arrival_station = arrival_station
+        self.window_start_ts = tt.minute(window_start)
+        self.window_end_ts = tt.minute(window_end)
+        self.max_ts = self.window_end_ts + int(max_delta * 60)
+        self.profiles = [self.StochasticProfile() for _ in range(self.n_stations)]
+        profiles = self.profiles
+        footpaths = self.walking_times.lists()
+        cdf_rows = tt.cdf_rows()
+        # Pareto set of the journeys continuing with each trip, from its last boarded connection
+        trip_options = {}
+        to_target = None if self.lower_bounds is None else self.lower_bounds[arrival_station].tolist()
+        from_origin = None if self.lower_bounds is None or departure_station is None else self.lower_bounds[:, departure_station].tolist()
+        # walking times from the departure station to the stations its journeys start from
+        origin_walks = {} if departure_station is None else \
+            {station: walking_time for station, walking_time in footpaths[departure_station] if station != arrival_station}
+        latest_ts = float("-inf") # departure of the latest journey from departure_station found so far
+        
+        lo, hi = tt.scan_range(self.window_start_ts, self.max_ts)
+        columns = zip(tt.trip[lo:hi].tolist(), tt.departure_station[lo:hi].tolist(), tt.arrival_station[lo:hi].tolist(),
+                      tt.departure_minute[lo:hi].tolist(), tt.arrival_minute[lo:hi].tolist(), tt.cdf[lo:hi].tolist())
+        
+        for i, (c_trip_id, c_departure_station, c_arrival_station, c_departure_ts, c_arrival_ts, c_cdf) in \
+                zip(range(hi - 1, lo - 1, -1), reversed(list(columns))):
+            
+            if c_departure_ts < latest_ts:
+                # all the journeys left to find depart earlier
+                break
+            if c_arrival_ts >= self.max_ts or (to_target is not None and c_arrival_ts + to_target[c_arrival_station] >= self.max_ts):
+                continue
+            if from_origin is not None and c_departure_ts < self.window_start_ts + from_origin[c_departure_station]:
+                continue
+            options = list(trip_options.get(c_trip_id, ()))
+            cdf = cdf_rows[c_cdf]
+            for station, walking_time in footpaths[c_arrival_station]:
+                if station == arrival_station:
+                    # leaves the trip at the target, or walks to it
+                    walk_ts = c_arrival_ts if station == c_arrival_station else c_arrival_ts + walking_time
+                    if walk_ts < self.max_ts:
+                        options.append((walk_ts, 1., i, None))
+                else:
+                    profiles[station].connecting(c_arrival_ts + walking_time, cdf, station, i, options)
+            if not options:
+                continue
+            
+            options = [option for option in self.pareto_options(options) if option[1] >= tolerance]
+            if not options:
+                continue
+            trip_options[c_trip_id] = options
+            if c_departure_station != arrival_station:
+                profile = profiles[c_departure_station]
+                for arrival_ts, route_prb, exit, next_entry in options:
+                    profile.add_entry(c_departure_ts, arrival_ts, route_prb, i, exit, next_entry)
+                if c_departure_station in origin_walks and options[0][0] <= self.window_end_ts:
+                    departure_ts = c_departure_ts - origin_walks[c_departure_station]
+                    if self.window_start_ts <= departure_ts <= self.window_end_ts:
+                        latest_ts = max(latest_ts, departure_ts)
+
+    def profile(self, departure_station):
+        """
+        Returns the journeys of the last profile computation from 'departure_station',
+        leaving within the departure window, that no other journey dominates (leaving 
+        later, arriving earlier and with a higher probability), by increasing departure.
+        """
+        tt = self.stochastic_timetable
+        candidates = []
+        for station, walking_time in self.walking_times.lists()[departure_station]:
+            if station == self.arrival_station:
+                continue
+            profile = self.profiles[station]
+            end = bisect_right(profile.neg_departures, -(self.window_start_ts + walking_time))
+            for e in range(end):
+                candidates.append((profile.departures[e] - walking_time, profile.arrivals[e], profile.probs[e], station, e))
+        
+        # latest departures first, each journey must improve on all the ones leaving later,
+        # including the ones leaving after the window (which are not returned)
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1], -candidate[2]))
+        journeys = []
+        f_arrivals, f_probs = [], []
+        for departure_ts, arrival_ts, route_prb, station, e in candidates:
+            i = bisect_right(f_arrivals, arrival_ts)
+            if route_prb <= (f_probs[i-1] if i else 0):
+                continue
+            i = bisect_left(f_arrivals, arrival_ts)
+            j = bisect_right(f_probs, route_prb, i)
+            f_arrivals[i:j] = (arrival_ts,)
+            f_probs[i:j] = (route_prb,)
+            if departure_ts <= self.window_end_ts:
+                journeys.append(ProfileJourney(tt.epoch + timedelta(minutes=departure_ts), tt.epoch + timedelta(minutes=arrival_ts),
+                                               route_prb, station, e))
+        return journeys[::-1]
+
+    def latest_departure(self, departure_station, arrival_time, tolerance):
+        """
+        Journey of the last profile computation that leaves 'departure_station' the
+        latest while arriving by 'arrival_time' with a probability of at least 
+        'tolerance' (the earliest arriving one in case of a tie), None if there is none
+        """
+        best = None
+        for journey in self.profile(departure_station):
+            if journey.arrival_timestamp <= arrival_time and journey.probability >= tolerance:
+                if best is None or journey.departure_timestamp > best.departure_timestamp \
+                    or (journey.departure_timestamp == best.departure_timestamp and journey.arrival_timestamp < best.arrival_timestamp):
+                    best = journey
+        return best
+
+    def get_profile_route(self, departure_station, journey):
+        """
+        Reconstruct the route of a journey returned by profile, in the format of 
+        get_route: the boarded and left connections of every trip, and the walks
+        """
+        route = []
+        tt = self.stochastic_timetable
+        station, e = journey.station, journey.entry
+        if station != departure_station:
+            route.append(self.generate_walk(departure_station, station, journey.departure_timestamp))
+        while True:
+            profile = self.profiles[station]
+            boarding, exit, next_entry = profile.boardings[e], profile.exits[e], profile.nexts[e]
+            route.append(tt[boarding])
+            exit_connection = tt[exit]
+            if exit != boarding:
+                route.append(exit_connection)
+            next_station = self.arrival_station if next_entry is None else next_entry[0]
+            if exit_connection["arrival_station"] != next_station:
+                route.append(self.generate_walk(exit_connection["arrival_station"], next_station, exit_connection["arrival_timestamp"]))
+            if next_entry is None:
+                return route
+            station, e = next_entry
@@ -1,80 +1,190 @@
-import os
-import pickle
-import pandas as pd
+import time
+from datetime import timedelta
+
+from batch import BatchQuery, run_batch, station_times
+from cache import QueryCache
+from datastore import depickle_mappings, get_store
 from helpers import StochasticCSA
-from scipy import sparse
+from metrics import Metrics, QueryStats, phase_timer
 
 
 class FrontBackInterface:
     """ This class serves as the interface between the backend implementations of our algorithms and the webserver frontend """
 
-    def __init__(self, mappings_dirpath="saved_data"):
-        """ Initializes needed data for the interface """
-        # Fetches the index/name station mappings and the timetable
-        self.station_idx, self.index_station, self.stochastic_timetable = self.depickle_mappings(mappings_dirpath)
+    def __init__(self, mappings_dirpath="saved_data", cache=True, metrics=None):
+        """ Initializes needed data for the interface, shared by all the interfaces of the process. cache: a QueryCache, True for a default one, None to disable. metrics: a Metrics that aggregates the stats of the queries, True for a new one """
+        self.store = get_store(mappings_dirpath)
+        self.cache = QueryCache() if cache is True else cache or None
+        self.metrics = Metrics() if metrics is True else metrics or None
+
+    @property
+    def data(self):
+        """ Current snapshot of the planner data, queries should read it once """
+        return self.store.data
+
+    @property
+    def station_idx(self):
+        return self.data.station_idx
+
+    @property
+    def index_station(self):
+        return self.data.index_station
 
-        # Fetches the adjacency matrix
-        FNAME_ADJMAT = os.path.join(mappings_dirpath, "adjacency_sparse.npz")
-        self.adjacency_sparse = sparse.load_npz(FNAME_ADJMAT)
+    @property
+    def stochastic_timetable(self):
+        return self.data.stochastic_timetable
 
-        # Fetches the list of stations with geo coordinates
-        station_meta_path = os.path.join(mappings_dirpath, "bfkoordgeo.csv")
-        station_meta_df = pd.read_csv(station_meta_path).head(-1)
-        self.station_coord = pd.Series(list(zip(station_meta_df.Longitude,station_meta_df.Latitude)), index=station_meta_df.Remark).to_dict()
+    @property
+    def adjacency_sparse(self):
+        return self.data.adjacency_sparse
+
+    @property
+    def station_coord(self):
+        return self.data.station_coord
+
+    @property
+    def station_search(self):
+        return self.data.station_search
+
+    @property
+    def n_stations(self):
+        return self.data.n_stations
 
-        self.n_stations = self.adjacency_sparse.shape[0]
-    
     def depickle_mappings(self, mappings_dirpath="saved_data"):
-        FNAME_S2I = os.path.join(mappings_dirpath, "station_index.pkl")
-        FNAME_I2S = os.path.join(mappings_dirpath, "index_station.pkl")        
-        FNAME_STOCHTT = os.path.join(mappings_dirpath, "stochastic_timetable.pkl")
-        # Depickles serialized items needed for our interface
-        with open(FNAME_S2I, "rb") as s2i, open(FNAME_I2S, "rb") as i2s, open(FNAME_STOCHTT, "rb") as serialized_table:
-            return pickle.load(s2i), pickle.load(i2s), pickle.load(serialized_table)
-
-    def journey_plan(self, departure_station, arrival_station, departure_time, tolerance, *, trip_window=4):
-        """ Plans one journey from departure_station to arrival_station (names) and returnsw a route structure with the steps """
-        departure_idx = self.station_idx[departure_station]
-        arrival_idx = self.station_idx[arrival_station]
-        csa = StochasticCSA(self.stochastic_timetable,self.adjacency_sparse)
-        csa.compute(departure_idx,departure_time,tolerance,trip_window,arrival_station=arrival_idx)
-        route = csa.get_route(departure_idx, arrival_idx, departure_time)
-        return route
-
-    def times_to_stations(self, departure_idx, departure_time, tolerance, *, trip_window=4):
-        """ Computes the times from the origin to all other stations. Impossible routes will convert to trip_window*60 min """
-        trip_length = {}
-        trip_length[self.index_station[departure_idx]] = 0.
-        csa = StochasticCSA(self.stochastic_timetable,self.adjacency_sparse)
-        csa.compute(departure_idx, departure_time, tolerance, trip_window)
-        for arrival_idx in range(self.n_stations):
-            if arrival_idx != departure_idx:
-                route = csa.get_route(departure_idx, arrival_idx, departure_time)
-                if route:
-                    last_c = route[-1]
-                    arrival_timestamp = last_c["arrival_timestamp"]
-                    difference = (arrival_timestamp-departure_time).seconds // 60
-                    trip_length[self.index_station[arrival_idx]] = difference
-                else:
-                    trip_length[self.index_station[arrival_idx]] = trip_window * 60
-                 
-        return trip_length
+        return depickle_mappings(mappings_dirpath)
+
+    def query_stats(self, kind, return_stats):
+        """ A QueryStats for a query whose stats are returned or aggregated, None otherwise (nothing is counted nor timed) """
+        return QueryStats(kind) if return_stats or self.metrics is not None else None
+
+    def finish_query(self, result, stats, start, return_stats):
+        """ Records the stats of a query in the metrics, returns its result (and stats if asked) """
+        if stats is not None:
+            stats.seconds = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.observe(stats)
+        return (result, stats) if return_stats else result
+
+    def journey_plan(self, departure_station, arrival_station, departure_time, tolerance, *, trip_window=4, return_stats=False, data=None):
+        """ Plans one journey from departure_station to arrival_station (names) and returnsw a route structure with the steps. With return_stats, returns (route, QueryStats). data: the snapshot to plan on, the current one by default """
+        start, stats = time.perf_counter(), self.query_stats("route", return_stats)
+        data = self.data if data is None else data
+        departure_idx = data.station_idx[departure_station]
+        arrival_idx = data.station_idx[arrival_station]
+        if self.cache is not None:
+            key = self.cache.key("route", departure_idx, arrival_idx, departure_time, tolerance, trip_window, data.version)
+            route = self.cache.get(key)
+            if route is not None:
+                if stats is not None:
+                    stats.cached = True
+                return self.finish_query(route, stats, start, return_stats)
+        csa = StochasticCSA(data.stochastic_timetable,data.footpaths,data.lower_bounds)
+        csa.compute(departure_idx,departure_time,tolerance,trip_window,arrival_station=arrival_idx,stats=stats)
+        route = csa.get_route(departure_idx, arrival_idx, departure_time, stats=stats)
+        if self.cache is not None:
+            self.cache.put(key, route)
+        return self.finish_query(route, stats, start, return_stats)
+
+    def journey_profile(self, departure_station, arrival_station, window_start, window_end, tolerance=0, *, trip_window=4):
+        """ Plans all the non-dominated journeys departing between window_start and window_end (one scan), returns a list of dicts with their probability and route """
+        data = self.data
+        departure_idx = data.station_idx[departure_station]
+        arrival_idx = data.station_idx[arrival_station]
+        csa = StochasticCSA(data.stochastic_timetable,data.footpaths)
+        csa.compute_profile(arrival_idx,window_start,window_end,trip_window)
+        return [{
+            "departure_timestamp": journey.departure_timestamp,
+            "arrival_timestamp": journey.arrival_timestamp,
+            "probability": journey.probability,
+            "route": csa.get_profile_route(departure_idx, journey),
+        } for journey in csa.profile(departure_idx) if journey.probability >= tolerance]
+
+    def arrive_by(self, departure_station, arrival_station, arrival_time, tolerance, *, trip_window=4, return_stats=False, data=None):
+        """ Plans the journey that leaves the latest while arriving by arrival_time with probability tolerance, returns a route structure like journey_plan. With return_stats, returns (route, QueryStats) with the phase timings only """
+        start, stats = time.perf_counter(), self.query_stats("arrive_by", return_stats)
+        data = self.data if data is None else data
+        departure_idx = data.station_idx[departure_station]
+        arrival_idx = data.station_idx[arrival_station]
+        csa = StochasticCSA(data.stochastic_timetable,data.footpaths,data.lower_bounds)
+        # journeys leaving at most trip_window hours before arrival_time, arriving within its minute,
+        # the scan stops at the latest one from the departure station
+        with phase_timer(stats, "compute_profile"):
+            csa.compute_profile(arrival_idx,arrival_time - timedelta(hours=trip_window),arrival_time,1/60,
+                                departure_station=departure_idx,tolerance=tolerance)
+        with phase_timer(stats, "get_route"):
+            journey = csa.latest_departure(departure_idx, arrival_time, tolerance)
+            route = [] if journey is None else csa.get_profile_route(departure_idx, journey)
+        return self.finish_query(route, stats, start, return_stats)
+
+    def times_to_stations(self, departure_idx, departure_time, tolerance, *, trip_window=4, return_stats=False):
+        """ Computes the times from the origin to all other stations. Impossible routes will convert to trip_window*60 min. With return_stats, returns (times, QueryStats) """
+        times = self.times_to_stations_by_tolerance(departure_idx, departure_time, [tolerance], trip_window=trip_window, return_stats=return_stats)
+        return (times[0][tolerance], times[1]) if return_stats else times[tolerance]
+
+    def times_to_stations_by_tolerance(self, departure_idx, departure_time, tolerances, *, trip_window=4, return_stats=False, data=None):
+        """ Same as times_to_stations for several tolerances, the ones that are not cached are answered by a single scan. Returns a dict tolerance->times (and a QueryStats with return_stats) """
+        start, stats = time.perf_counter(), self.query_stats("times", return_stats)
+        data = self.data if data is None else data
+        times, keys = {}, {}
+        if self.cache is not None:
+            for tolerance in tolerances:
+                keys[tolerance] = self.cache.key("times", departure_idx, None, departure_time, tolerance, trip_window, data.version)
+                cached = self.cache.get(keys[tolerance])
+                if cached is not None:
+                    times[tolerance] = cached
+        missing = [tolerance for tolerance in tolerances if tolerance not in times]
+        if not missing:
+            if stats is not None:
+                stats.cached = True
+            return self.finish_query(times, stats, start, return_stats)
+        csa = StochasticCSA(data.stochastic_timetable,data.footpaths)
+        csa.compute(departure_idx, departure_time, missing, trip_window, stats=stats)
+        for tolerance in missing:
+            trip_length = station_times(data, csa.one_to_all(tolerance, stats=stats), departure_idx, trip_window)
+            times[tolerance] = trip_length
+            if self.cache is not None:
+                self.cache.put(keys[tolerance], trip_length)
+        return self.finish_query(times, stats, start, return_stats)
+
+    def stream_times_to_stations(self, departure_idx, departure_time, tolerances, *, trip_window=4, step=5, data=None):
+        """ Same as times_to_stations_by_tolerance, but yields the stations as the scan settles them, in lists of (station name, minutes, route probability, tolerance) per 'step' minutes of departures; unreachable stations come last, with None minutes. The times are cached once the scan is complete """
+        start, stats = time.perf_counter(), self.query_stats("times_stream", False)
+        data = self.data if data is None else data
+        csa = StochasticCSA(data.stochastic_timetable,data.footpaths)
+        times = {tolerance: {} for tolerance in tolerances}
+        for settled in csa.settle(departure_idx, departure_time, tolerances, trip_window, step=step, stats=stats):
+            batch = []
+            for station, minutes, probability, tolerance in settled:
+                minutes = None if minutes != minutes else minutes # nan if unreachable
+                times[tolerance][station] = trip_window * 60 if minutes is None else minutes
+                batch.append((data.index_station[station], minutes, probability, tolerance))
+            yield batch
+        if self.cache is not None:
+            for tolerance, station_minutes in times.items():
+                # same dict as times_to_stations
+                station_minutes[departure_idx] = 0.
+                trip_length = {data.index_station[station]: station_minutes[station] for station in range(data.n_stations)}
+                self.cache.put(self.cache.key("times", departure_idx, None, departure_time, tolerance, trip_window, data.version), trip_length)
+        self.finish_query(None, stats, start, False)
+
+    def batch_plan(self, queries, *, trip_window=4, processes=None):
+        """ Answers (origin, destination or None, departure_time, tolerance) queries in parallel, one scan per origin and departure time. Yields (query idx, route or times to all stations) as they complete """
+        queries = [BatchQuery(*query) for query in queries]
+        return run_batch(self.data, queries, trip_window=trip_window, processes=processes)
 
     def times_to_stations_from_hbf(self, departure_time, tolerance, *, trip_window=4):
         """ Legacy function from the previous versions where isochrones were computed from Hauptbahnhof only """
         zurich_idx = self.station_idx["Zürich HB"]
         return self.times_to_stations(zurich_idx,departure_time,tolerance,trip_window=trip_window)
 
-    def latlon(self, station_identifier):
-        """ Returns (lon, lat) of station (accepts id:int or name:str) """
-        lon, lat = self.station_coord[station_identifier]
+    def latlon(self, station_identifier, data=None):
+        """ Returns (lon, lat) of station (accepts id:int or name:str), in the data snapshot if given """
+        lon, lat = (self.data if data is None else data).station_coord[station_identifier]
         return lat, lon
 
     def get_stations_metadata(self):
-        """ Returns a df of stations metadata """
-        station_meta_path = 'metadata/bfkoordgeo.csv'
-        station_meta_df = pd.read_csv(station_meta_path).head(-1)
-        return station_meta_df
+        """ Returns a df of stations metadata (parsed once when the data is loaded) """
+        return self.data.station_meta_df
 
 if __name__=="__main__":
     # testing calls
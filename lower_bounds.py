@@ -0,0 +1,124 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+
+from footpaths import FootpathIndex
+from timetable import TIMETABLE_DIRNAME, load_timetable
+
+logger = logging.getLogger(__name__)
+
+LOWER_BOUNDS_FNAME = "lower_bounds.npy"
+CHUNK_SIZE = 256 # targets per Dijkstra call, bounds the float64 buffer to CHUNK_SIZE x n_stations
+
+
+def ride_minutes(timetable):
+    """
+    Minutes from being at the departure station of every connection to being at its
+    arrival station: the ride itself, or from the arrival of the previous connection
+    of the trip if it arrives after this one departs (so that staying on board never
+    takes less time than the bound)
+    """
+    order = np.lexsort((timetable.departure_minute, timetable.trip))
+    arrivals = timetable.arrival_minute[order].astype(np.float64)
+    departures = timetable.departure_minute[order].astype(np.float64)
+    trips = timetable.trip[order]
+    same_trip = np.zeros(len(order), dtype=bool)
+    same_trip[1:] = trips[1:] == trips[:-1]
+    boarded = departures.copy()
+    boarded[1:] = np.where(same_trip[1:], np.maximum(departures[1:], arrivals[:-1]), departures[1:])
+    minutes = np.empty(len(order))
+    minutes[order] = np.maximum(arrivals - boarded, 0)
+    return minutes
+
+
+def travel_graph(timetable, footpaths):
+    """
+    Sparse graph of the shortest ride of every pair of consecutive stops of the
+    timetable and of the footpaths (self-loops excluded), in minutes
+    """
+    n = footpaths.n_stations
+    walk_from = np.repeat(np.arange(n), np.diff(footpaths.indptr))
+    walks = walk_from != footpaths.indices
+    rows = np.concatenate((timetable.departure_station.astype(np.int64), walk_from[walks]))
+    cols = np.concatenate((timetable.arrival_station.astype(np.int64), footpaths.indices[walks].astype(np.int64)))
+    minutes = np.concatenate((ride_minutes(timetable), footpaths.minutes[walks]))
+    # keeps the shortest edge of every pair, the csr constructor would add them up
+    order = np.lexsort((minutes, cols, rows))
+    rows, cols, minutes = rows[order], cols[order], minutes[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return sparse.csr_matrix((minutes[first], (rows[first], cols[first])), shape=(n, n))
+
+
+def build_lower_bounds(timetable, footpaths, out_fpath=None):
+    """
+    Lower bounds of the travel time between all pairs of stations, whatever the time
+    of day: row t holds the minutes from every station to station t (inf if t can
+    not be reached), rounded down to whole minutes so that they are exact in float32.
+    Computed by Dijkstra from every target on the reversed graph, written to
+    'out_fpath' chunk by chunk if given (the matrix grows with n_stations^2).
+    """
+    if not isinstance(footpaths, FootpathIndex):
+        footpaths = FootpathIndex.from_adjacency(footpaths)
+    n = footpaths.n_stations
+    reversed_graph = travel_graph(timetable, footpaths).T.tocsr()
+    if out_fpath is None:
+        bounds = np.empty((n, n), dtype=np.float32)
+    else:
+        bounds = np.lib.format.open_memmap(out_fpath, mode="w+", dtype=np.float32, shape=(n, n))
+    for start in range(0, n, CHUNK_SIZE):
+        targets = np.arange(start, min(start + CHUNK_SIZE, n))
+        bounds[targets] = np.floor(dijkstra(reversed_graph, directed=True, indices=targets))
+    if out_fpath is not None:
+        bounds.flush()
+    return bounds
+
+
+def save_lower_bounds(mappings_dirpath="saved_data"):
+    """ Builds the lower bounds of the timetable and footpaths of 'mappings_dirpath' into its lower_bounds.npy """
+    start = time.perf_counter()
+    timetable = load_timetable(mappings_dirpath)
+    footpaths = FootpathIndex.from_adjacency(sparse.load_npz(os.path.join(mappings_dirpath, "adjacency_sparse.npz")))
+    fpath = os.path.join(mappings_dirpath, LOWER_BOUNDS_FNAME)
+    # written next to the file and renamed, a running planner never loads a partial matrix
+    bounds = build_lower_bounds(timetable, footpaths, fpath + ".tmp")
+    del bounds
+    os.replace(fpath + ".tmp", fpath)
+    logger.info("built the lower bounds of %d stations in %.1f s", footpaths.n_stations, time.perf_counter() - start)
+    return fpath
+
+
+def load_lower_bounds(mappings_dirpath="saved_data", n_stations=None):
+    """
+    Memory-maps the lower bounds of 'mappings_dirpath', or returns None if there are
+    none, if they do not match 'n_stations', or if they are older than the timetable
+    or the footpaths they derive from (they would not be lower bounds anymore)
+    """
+    fpath = os.path.join(mappings_dirpath, LOWER_BOUNDS_FNAME)
+    if not os.path.exists(fpath):
+        return None
+    sources = [os.path.join(mappings_dirpath, "adjacency_sparse.npz")]
+    timetable_dirpath = os.path.join(mappings_dirpath, TIMETABLE_DIRNAME)
+    if os.path.isdir(timetable_dirpath):
+        sources += [os.path.join(timetable_dirpath, fname) for fname in os.listdir(timetable_dirpath) if fname != "cdfs.npy"]
+    if any(os.path.getmtime(source) > os.path.getmtime(fpath) for source in sources if os.path.exists(source)):
+        logger.warning("ignoring %s, it is older than the timetable or the footpaths (rebuild it with lower_bounds.py)", fpath)
+        return None
+    bounds = np.load(fpath, mmap_mode="r")
+    if n_stations is not None and bounds.shape != (n_stations, n_stations):
+        logger.warning("ignoring %s, its shape %s does not match the %d stations", fpath, bounds.shape, n_stations)
+        return None
+    return bounds
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Precomputes the station-to-station travel time lower bounds used to prune point-to-point queries")
+    parser.add_argument("mappings_dirpath", nargs="?", default="saved_data")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print("saved", save_lower_bounds(args.mappings_dirpath))
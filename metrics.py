@@ -0,0 +1,159 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.) # seconds
+COUNT_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+
+class QueryStats:
+    """
+    Counters and phase timings (in seconds) of one query. StochasticCSA fills them
+    when it is given a QueryStats, and does not count or time anything otherwise.
+    Queries that do not run a forward scan have no counters.
+    """
+
+    COUNTERS = (
+        "connections_scanned", # departing in the trip window, before the scan stopped at the earliest arrival
+        "connections_pruned", # skipped because their lower bound to the target arrives after the earliest arrival
+        "connections_reachable", # whose departure station was reached in time, or whose trip was boarded
+        "connections_feasible", # that passed the tolerance, and relaxed the footpaths of their arrival station
+        "footpath_relaxations", # table updates, one per footpath (self-loop included) of a feasible connection
+        "table_inserts", # labels created by the updates
+        "table_entries", # entries left in the Pareto sets at the end of the scan
+        "max_table_entries", # entries of the largest Pareto set
+        "trips", # trips boarded
+    )
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.cached = False
+        self.seconds = None # total latency, set once the query is answered
+        self.counters = {}
+        self.phases = {}
+
+    def start_counting(self):
+        """ Returns the counters, initialized to 0 """
+        for name in self.COUNTERS:
+            self.counters.setdefault(name, 0)
+        return self.counters
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = self.phases.get(phase, 0.) + time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            "kind": self.kind,
+            "cached": self.cached,
+            "total_ms": None if self.seconds is None else self.seconds * 1e3,
+            "counters": dict(self.counters),
+            "phases_ms": {phase: seconds * 1e3 for phase, seconds in self.phases.items()},
+        }
+
+
+def phase_timer(stats, phase):
+    """ Times 'phase' into stats, or does nothing if stats is None """
+    return nullcontext() if stats is None else stats.timer(phase)
+
+
+class Histogram:
+    """ Cumulative histogram in the Prometheus sense: counts of the observations lower or equal to each bound """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # last one is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """ Lines of the histogram in the Prometheus text format """
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            cumulative += count
+            yield "%s_bucket{%s} %d" % (name, format_labels(labels + (("le", str(bound)),)), cumulative)
+        yield "%s_sum{%s} %s" % (name, format_labels(labels), repr(float(self.sum)))
+        yield "%s_count{%s} %d" % (name, format_labels(labels), self.count)
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels)
+
+
+class Metrics:
+    """
+    Aggregates the QueryStats of the queries of a process into histograms of their
+    latency, phase timings and counters, rendered in the Prometheus text format.
+    Thread-safe, so that it can be shared by the requests of a web server.
+    """
+
+    PREFIX = "journey_planner"
+    HELP = {
+        "queries_total": ("counter", "Queries answered, by kind and whether they were cached"),
+        "query_seconds": ("histogram", "Latency of the queries"),
+        "phase_seconds": ("histogram", "Time spent in each phase of the computed queries"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queries = {} # (kind, cached) -> count
+        self._latencies = {} # kind -> Histogram
+        self._phases = {} # (kind, phase) -> Histogram
+        self._counters = {} # (counter, kind) -> Histogram
+
+    def observe(self, stats):
+        """ Records one answered query """
+        with self._lock:
+            key = (stats.kind, "true" if stats.cached else "false")
+            self._queries[key] = self._queries.get(key, 0) + 1
+            self._histogram(self._latencies, stats.kind, LATENCY_BUCKETS).observe(stats.seconds)
+            if stats.cached:
+                return
+            for phase, phase_seconds in stats.phases.items():
+                self._histogram(self._phases, (stats.kind, phase), LATENCY_BUCKETS).observe(phase_seconds)
+            for counter, value in stats.counters.items():
+                self._histogram(self._counters, (counter, stats.kind), COUNT_BUCKETS).observe(value)
+
+    @staticmethod
+    def _histogram(histograms, key, bounds):
+        if key not in histograms:
+            histograms[key] = Histogram(bounds)
+        return histograms[key]
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format (version 0.0.4) """
+        lines = []
+        with self._lock:
+            lines += self._header("queries_total", *self.HELP["queries_total"])
+            for (kind, cached), count in sorted(self._queries.items()):
+                lines.append("%s_queries_total{%s} %d" % (self.PREFIX, format_labels((("kind", kind), ("cached", cached))), count))
+            lines += self._header("query_seconds", *self.HELP["query_seconds"])
+            for kind, histogram in sorted(self._latencies.items()):
+                lines += histogram.samples(self.PREFIX + "_query_seconds", (("kind", kind),))
+            lines += self._header("phase_seconds", *self.HELP["phase_seconds"])
+            for (kind, phase), histogram in sorted(self._phases.items()):
+                lines += histogram.samples(self.PREFIX + "_phase_seconds", (("kind", kind), ("phase", phase)))
+            for counter in QueryStats.COUNTERS:
+                histograms = sorted((kind, histogram) for (name, kind), histogram in self._counters.items() if name == counter)
+                if not histograms:
+                    continue
+                lines += self._header(counter, "histogram", "Per query: " + counter.replace("_", " "))
+                for kind, histogram in histograms:
+                    lines += histogram.samples("%s_%s" % (self.PREFIX, counter), (("kind", kind),))
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name, metric_type, description):
+        return ["# HELP %s_%s %s" % (self.PREFIX, name, description), "# TYPE %s_%s %s" % (self.PREFIX, name, metric_type)]
@@ -0,0 +1,151 @@
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from footpaths import haversine
+
+
+def normalize_char(c):
+    """ Accent-insensitive, case-insensitive form of a character ('' for combining marks, ' ' for separators) """
+    decomposed = "".join(d for d in unicodedata.normalize("NFKD", c) if not unicodedata.combining(d)).casefold()
+    return decomposed if decomposed.isalnum() else (" " if decomposed else "")
+
+
+def normalize(name):
+    """ Normalized form of a station name or query: no accents, lower case, words separated by single spaces """
+    return normalized_positions(name)[0]
+
+
+def normalized_positions(name):
+    """ Returns the normalized name, and for each of its characters the position of the character of 'name' it comes from """
+    chars, positions = [], []
+    for i, c in enumerate(name):
+        for n in normalize_char(c):
+            if n == " " and (not chars or chars[-1] == " "):
+                continue
+            chars.append(n)
+            positions.append(i)
+    if chars and chars[-1] == " ":
+        chars.pop()
+        positions.pop()
+    return "".join(chars), positions
+
+
+def prefix_distances(codes, lengths, query, max_distance):
+    """
+    Edit distance between 'query' and the closest prefix of every key (rows of
+    'codes', code points padded with 0), computed for all keys at once
+    """
+    n_keys, width = codes.shape
+    q = np.array([ord(c) for c in query], dtype=codes.dtype)
+    # previous row of the DP table: distances between the empty query and the prefixes of the keys
+    previous = np.tile(np.arange(width + 1, dtype=np.int32), (n_keys, 1))
+    for i in range(1, len(q) + 1):
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        mismatch = (codes != q[i - 1]).astype(np.int32)
+        for j in range(1, width + 1):
+            current[:, j] = np.minimum(np.minimum(previous[:, j], current[:, j - 1]) + 1, previous[:, j - 1] + mismatch[:, j - 1])
+        previous = current
+    # prefixes of len(query) +- max_distance characters, that do not go past the end of the key
+    j = np.arange(width + 1)
+    in_range = (np.abs(j - len(query)) <= max_distance)[None, :] & (j[None, :] <= lengths[:, None])
+    return np.where(in_range, previous, np.iinfo(np.int32).max).min(axis=1)
+
+
+def typo_budget(query):
+    """ Number of typos tolerated in a query of this length """
+    return 0 if len(query) < 3 else 1 if len(query) < 7 else 2
+
+
+class StationSearch:
+    """
+    Search index of the station names, built once per snapshot of the data. Names
+    are normalized (accents, case and punctuation are ignored), and the normalized
+    full name and every suffix starting at a word are kept in one sorted array, so
+    that "oerlikon" finds "Zürich Oerlikon" with a bisection. When nothing starts
+    with the query, names are matched with typos, and stations can also be looked
+    up by their distance to a coordinate (KD-tree on the unit sphere).
+    """
+
+    def __init__(self, index_station, station_coord):
+        self.names = [index_station[i] for i in range(len(index_station))]
+        self.positions = []
+        entries = []
+        for station, name in enumerate(self.names):
+            key, positions = normalized_positions(name)
+            self.positions.append(positions)
+            for start in [0] + [i + 1 for i, c in enumerate(key) if c == " "]:
+                entries.append((key[start:], station, start))
+        entries.sort()
+        self.keys = [key for key, _, _ in entries]
+        self.key_stations = [station for _, station, _ in entries]
+        self.key_starts = [start for _, _, start in entries]
+        width = max((len(key) for key in self.keys), default=0)
+        self.key_codes = np.zeros((len(self.keys), width), dtype=np.uint32)
+        for i, key in enumerate(self.keys):
+            self.key_codes[i, :len(key)] = [ord(c) for c in key]
+        self.key_lengths = np.array([len(key) for key in self.keys], dtype=np.int64)
+
+        self.located = np.array([station for station, name in enumerate(self.names) if name in station_coord], dtype=np.int64)
+        lon, lat = np.array([station_coord[self.names[station]] for station in self.located], dtype=np.float64).reshape(-1, 2).T
+        phi, lam = np.radians(lat), np.radians(lon)
+        self.lon, self.lat = lon, lat
+        self.tree = cKDTree(np.column_stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)))) if len(self.located) else None
+
+    def match(self, station, start, length):
+        """ A match of 'length' normalized characters from 'start' in the name of 'station', with the matched span of the name """
+        positions = self.positions[station]
+        end = min(start + length, len(positions))
+        span = [positions[start], positions[end - 1] + 1] if end > start else [0, 0]
+        return {"name": self.names[station], "highlight": span}
+
+    def prefix_matches(self, query):
+        """ (station, start of the match in its normalized name) of all the keys starting with the normalized query """
+        matches = {}
+        for i in range(bisect_left(self.keys, query), len(self.keys)):
+            if not self.keys[i].startswith(query):
+                break
+            station = self.key_stations[i]
+            matches[station] = min(matches.get(station, self.key_starts[i]), self.key_starts[i])
+        return matches
+
+    def search(self, query, k=10, typos=True):
+        """
+        Returns the k best matches of 'query', as dicts with the station name and the
+        [start, end) span of the name that matched. Matches at the start of the name
+        come first, then matches of a later word, shorter names first. If there are
+        none (and with 'typos'), names with a prefix within a few edits of the query
+        are returned instead, closest first.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        matches = self.prefix_matches(query)
+        ranked = sorted(matches.items(), key=lambda match: (match[1] > 0, len(self.names[match[0]]), self.names[match[0]]))
+        results = [self.match(station, start, len(query)) for station, start in ranked[:k]]
+        max_distance = typo_budget(query)
+        if typos and not results and max_distance and len(self.keys):
+            width = min(len(query) + max_distance, self.key_codes.shape[1])
+            distances = prefix_distances(self.key_codes[:, :width], np.minimum(self.key_lengths, width), query, max_distance)
+            fuzzy = {}
+            for i in np.flatnonzero(distances <= max_distance).tolist():
+                station = self.key_stations[i]
+                rank = (int(distances[i]), self.key_starts[i] > 0, len(self.names[station]), self.names[station])
+                if station not in fuzzy or rank < fuzzy[station][0]:
+                    fuzzy[station] = (rank, self.key_starts[i])
+            results = [self.match(station, start, len(query)) for station, (_, start) in sorted(fuzzy.items(), key=lambda item: item[1][0])[:k]]
+        return results
+
+    def nearest(self, lat, lon, k=10):
+        """ The k stations closest to (lat, lon), as dicts with the station name and its distance in km """
+        if self.tree is None:
+            return []
+        phi, lam = np.radians(lat), np.radians(lon)
+        k = min(k, len(self.located))
+        _, idxs = self.tree.query([np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)], k=k)
+        idxs = np.atleast_1d(idxs)
+        distances = haversine(self.lon[idxs], self.lat[idxs], lon, lat)
+        return [{"name": self.names[self.located[i]], "distance_km": round(float(d), 3)} for i, d in zip(idxs.tolist(), distances.tolist())]
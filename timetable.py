@@ -0,0 +1,251 @@
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+TIMETABLE_DIRNAME = "timetable"
+VERSIONS_SUFFIX = ".versions" # timetable.versions/ holds the compiled versions, timetable is a symlink to the current one
+N_DAYS = 7 # days of the week, labeled 1 (Sunday) to 7 (Saturday) as in Spark's dayofweek
+N_HOURS = 24
+N_BINS = 11 # delays clipped to [0,10] minutes
+
+
+class ColumnarTimetable:
+    """
+    A stochastic timetable stored as NumPy columns, sorted by departure time,
+    that may cover several service days. Timestamps are integer minutes since
+    'epoch' (midnight of the first service day), trip ids are interned, and
+    each connection only keeps a small index into one shared CDF matrix,
+    whose rows correspond to the (type, day of week, hour) distributions of
+    final_cdfs plus one last row for the general CDF. Types without a delay
+    model (e.g. the empty type) come after the modeled ones in 'types', they
+    have no rows and their connections use the general CDF.
+    """
+
+    COLUMNS = {
+        "departure_station": np.int32,
+        "arrival_station": np.int32,
+        "departure_minute": np.int32,
+        "arrival_minute": np.int32,
+        "trip": np.int32, # idx in trip_ids
+        "type": np.uint8, # idx in types
+        "cdf": np.uint16, # row in cdfs
+    }
+
+    def __init__(self, columns, trip_ids, types, cdfs, epoch):
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self.trip_ids = trip_ids
+        self.types = list(types)
+        self.cdfs = cdfs
+        self.epoch = epoch
+
+    def with_cdfs(self, cdfs):
+        """ Returns a timetable sharing the columns of this one, with another CDF matrix """
+        return ColumnarTimetable({name: getattr(self, name) for name in self.COLUMNS}, self.trip_ids, self.types, cdfs, self.epoch)
+
+    def __len__(self):
+        return len(self.departure_minute)
+
+    def __getitem__(self, i):
+        """ Returns connection i as a dict, in the format of the legacy stochastic_timetable.pkl """
+        return {
+            "trip_id": str(self.trip_ids[self.trip[i]]),
+            "type": self.types[self.type[i]],
+            "departure_station": int(self.departure_station[i]),
+            "arrival_station": int(self.arrival_station[i]),
+            "departure_timestamp": self.timestamp(self.departure_minute[i]),
+            "arrival_timestamp": self.timestamp(self.arrival_minute[i]),
+            "cdf": self.cdfs[self.cdf[i]].tolist(),
+        }
+
+    def minute(self, timestamp):
+        """
+        Converts a datetime to minutes since the epoch of the timetable, with the fraction of
+        the seconds: a query at 12:00:30 can not board a connection departing at 12:00 (the
+        minutes of the connections are whole, see from_connections)
+        """
+        return (timestamp - self.epoch).total_seconds() / 60
+
+    def timestamp(self, minute):
+        """ Converts minutes since the epoch of the timetable back to a datetime """
+        return self.epoch + timedelta(minutes=int(minute))
+
+    def scan_range(self, start_minute, end_minute):
+        """
+        Returns the slice [lo, hi) of connections departing between 'start_minute' 
+        and 'end_minute' (both included), found by binary search on the departures
+        """
+        lo = int(np.searchsorted(self.departure_minute, start_minute, side="left"))
+        hi = int(np.searchsorted(self.departure_minute, end_minute, side="right"))
+        return lo, hi
+
+    def service_period(self):
+        """ Returns the first and last departure timestamps of the timetable """
+        if len(self) == 0:
+            return None, None
+        return self.timestamp(self.departure_minute[0]), self.timestamp(self.departure_minute[-1])
+
+    def n_modeled_types(self):
+        """ Number of types with rows in the CDF matrix, the first ones of 'types' """
+        return (len(self.cdfs) - 1) // (N_DAYS * N_HOURS)
+
+    def cdf_rows(self):
+        """ Returns the shared CDF matrix as a list of lists, for fast scalar indexing """
+        return self.cdfs.tolist()
+
+    @staticmethod
+    def cdf_row(type_idx, day, hour):
+        """ Row of the CDF matrix holding the distribution of (type, day of week, hour) """
+        return (type_idx * N_DAYS + day - 1) * N_HOURS + hour
+
+    @classmethod
+    def from_connections(cls, connections, types=None, final_cdfs=None):
+        """
+        Compiles a list of connection dicts (as produced by the notebook) into
+        columns. Connections may span any number of days, they are sorted by
+        departure timestamp (stable, so that the order of a trip is kept). The CDF of a
+        connection is taken from its own 'cdf' entry, rows of the matrix that no
+        connection uses are filled from 'final_cdfs' when given. Types of connections
+        that are not in 'types' are appended to the types of the timetable.
+        """
+        connections = sorted(connections, key=lambda c: c["departure_timestamp"])
+        if types is None:
+            types = sorted({c["type"] for c in connections if c["type"]})
+        type_index = {t: i for i, t in enumerate(types)}
+        general_row = len(types) * N_DAYS * N_HOURS
+        # every type keeps its own name, the ones without rows included
+        names = list(types) + sorted({c["type"] for c in connections} - set(type_index))
+        name_index = {t: i for i, t in enumerate(names)}
+        cdfs = np.ones((general_row + 1, N_BINS), dtype=np.float64)
+        filled = np.zeros(general_row + 1, dtype=bool)
+        if final_cdfs is not None:
+            for t, day_cdfs in final_cdfs.items():
+                if t not in type_index:
+                    continue
+                for day, hour_cdfs in day_cdfs.items():
+                    for hour, cdf in hour_cdfs.items():
+                        cdfs[cls.cdf_row(type_index[t], day, hour)] = cdf
+
+        epoch = datetime.combine(connections[0]["departure_timestamp"].date(), datetime.min.time()) if connections else datetime(1970, 1, 1)
+        n = len(connections)
+        columns = {name: np.empty(n, dtype=dtype) for name, dtype in cls.COLUMNS.items()}
+        trip_index = {}
+        for i, c in enumerate(connections):
+            c_type, c_day, c_hour = c["type"], c.get("c_day"), c.get("c_hour")
+            if c_type in type_index and c_day is not None and c_hour is not None:
+                row = cls.cdf_row(type_index[c_type], c_day, c_hour)
+            else:
+                row = general_row
+            if not filled[row]:
+                cdfs[row] = c["cdf"]
+                filled[row] = True
+            columns["departure_station"][i] = c["departure_station"]
+            columns["arrival_station"][i] = c["arrival_station"]
+            columns["departure_minute"][i] = (c["departure_timestamp"] - epoch).total_seconds() // 60
+            columns["arrival_minute"][i] = (c["arrival_timestamp"] - epoch).total_seconds() // 60
+            columns["trip"][i] = trip_index.setdefault(c["trip_id"], len(trip_index))
+            columns["type"][i] = name_index[c_type]
+            columns["cdf"][i] = row
+        trip_ids = np.array(list(trip_index), dtype=str) if trip_index else np.empty(0, dtype="<U1")
+        return cls(columns, trip_ids, names, cdfs, epoch)
+
+    def save(self, dirpath):
+        """
+        Writes the columns as .npy files (so that they can be memory-mapped) and the metadata as
+        json, in a new version directory that 'dirpath' is then pointed to. The files of the
+        previous version are never written over, the processes that map them keep a consistent
+        timetable. meta.json is written last, a version without it is incomplete.
+        """
+        versions_dirpath = dirpath.rstrip(os.sep) + VERSIONS_SUFFIX
+        version_dirpath = os.path.join(versions_dirpath, "%d-%d" % (time.time_ns(), os.getpid()))
+        os.makedirs(version_dirpath)
+        for name in self.COLUMNS:
+            np.save(os.path.join(version_dirpath, name + ".npy"), getattr(self, name))
+        np.save(os.path.join(version_dirpath, "trip_ids.npy"), self.trip_ids)
+        np.save(os.path.join(version_dirpath, "cdfs.npy"), self.cdfs)
+        with open(os.path.join(version_dirpath, "meta.json"), "w") as meta:
+            json.dump({"epoch": self.epoch.isoformat(), "types": self.types, "n_connections": len(self)}, meta)
+        switch_version(dirpath, version_dirpath)
+
+    @classmethod
+    def load(cls, dirpath, mmap_mode="r"):
+        """ Loads a compiled timetable, memory-mapping the columns by default """
+        # the pointer is resolved once, all the files come from the same version
+        dirpath = os.path.realpath(dirpath)
+        with open(os.path.join(dirpath, "meta.json")) as meta:
+            meta = json.load(meta)
+        columns = {name: np.load(os.path.join(dirpath, name + ".npy"), mmap_mode=mmap_mode) for name in cls.COLUMNS}
+        trip_ids = np.load(os.path.join(dirpath, "trip_ids.npy"), mmap_mode=mmap_mode)
+        cdfs = np.load(os.path.join(dirpath, "cdfs.npy"))
+        return cls(columns, trip_ids, meta["types"], cdfs, datetime.fromisoformat(meta["epoch"]))
+
+
+def switch_version(dirpath, version_dirpath):
+    """
+    Atomically points the symlink 'dirpath' to 'version_dirpath' (a directory compiled before
+    versions were used becomes a version first). The version it replaces is kept for the
+    processes that are still loading it, older ones are removed: the files stay valid for
+    the processes that map them until they unmap them.
+    """
+    versions_dirpath = os.path.dirname(version_dirpath)
+    previous = os.path.realpath(dirpath) if os.path.islink(dirpath) else None
+    if os.path.isdir(dirpath) and not os.path.islink(dirpath):
+        previous = os.path.join(versions_dirpath, "unversioned-%d" % time.time_ns())
+        os.rename(dirpath, previous)
+    # the new link is created in the versions directory, which the planner does not watch, and renamed over the old one
+    link_path = os.path.join(versions_dirpath, ".link-%d" % os.getpid())
+    os.symlink(os.path.relpath(version_dirpath, os.path.dirname(os.path.abspath(dirpath))), link_path)
+    os.replace(link_path, dirpath)
+    for name in os.listdir(versions_dirpath):
+        path = os.path.join(versions_dirpath, name)
+        if path not in (version_dirpath, previous) and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def is_complete(dirpath):
+    """ Whether the compiled timetable 'dirpath' is missing or complete (has its meta.json) """
+    return not os.path.isdir(dirpath) or os.path.exists(os.path.join(dirpath, "meta.json"))
+
+
+def load_timetable(mappings_dirpath="saved_data"):
+    """
+    Loads the compiled timetable of 'mappings_dirpath' if there is one, and
+    falls back to compiling stochastic_timetable.pkl in memory otherwise
+    """
+    compiled_dirpath = os.path.join(mappings_dirpath, TIMETABLE_DIRNAME)
+    if os.path.exists(os.path.join(compiled_dirpath, "meta.json")):
+        return ColumnarTimetable.load(compiled_dirpath)
+    with open(os.path.join(mappings_dirpath, "stochastic_timetable.pkl"), "rb") as serialized_table:
+        connections = pickle.load(serialized_table)
+    return ColumnarTimetable.from_connections(connections, *load_delay_model(mappings_dirpath))
+
+
+def load_delay_model(mappings_dirpath="saved_data"):
+    """ Returns the list of transport types and final_cdfs, or (None, None) if they were not saved """
+    FNAME_TYPES = os.path.join(mappings_dirpath, "type_list.pkl")
+    FNAME_CDFS = os.path.join(mappings_dirpath, "final_cdfs.pkl")
+    if not (os.path.exists(FNAME_TYPES) and os.path.exists(FNAME_CDFS)):
+        return None, None
+    with open(FNAME_TYPES, "rb") as types, open(FNAME_CDFS, "rb") as cdfs:
+        return pickle.load(types), pickle.load(cdfs)
+
+
+def compile_timetable(mappings_dirpath="saved_data"):
+    """ Compiles stochastic_timetable.pkl of 'mappings_dirpath' into its columnar format """
+    with open(os.path.join(mappings_dirpath, "stochastic_timetable.pkl"), "rb") as serialized_table:
+        connections = pickle.load(serialized_table)
+    timetable = ColumnarTimetable.from_connections(connections, *load_delay_model(mappings_dirpath))
+    timetable.save(os.path.join(mappings_dirpath, TIMETABLE_DIRNAME))
+    return timetable
+
+
+if __name__=="__main__":
+    # compiles the pickled timetable of the given directory
+    timetable = compile_timetable(sys.argv[1] if len(sys.argv) > 1 else "saved_data")
+    print("compiled", len(timetable), "connections,", len(timetable.trip_ids), "trips")